@@ -0,0 +1,243 @@
+"""
+Benchmarks loading, validation, conversion and serialization of messages for each source.
+
+The messages are synthetic and are generated according to the sources' schemas. Usage:
+
+    python scripts/benchmark.py --size 20000
+    python scripts/benchmark.py --size 20000 --save  # updates the baseline
+
+Fails if any stage became slower than the baseline by more than `--tolerance`.
+The Slack converters need the emoji assets from `download-assets.sh`.
+"""
+import datetime
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import deli
+import rich
+import typer
+from rich.table import Table
+
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from src.settings import settings  # noqa
+from src.slack.interface import Slack  # noqa
+from src.storage import save_messages  # noqa
+from src.telegram_export.interface import TelegramExport  # noqa
+from src.telegram_sdk.interface import TelegramSDK  # noqa
+
+
+BASELINE = Path(__file__).resolve().parent / 'benchmark-baseline.json'
+CHAT_ID = '1'
+USERS = [f'U{i}' for i in range(20)]
+WORDS = 'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt'.split()
+START = 1_600_000_000
+
+
+def main(size: int = 10_000, seed: int = 0, baseline: Path = BASELINE, save: bool = False,
+         tolerance: float = 0.2):
+    settings.base_url = settings.base_url or 'http://localhost'
+    results = {}
+    with tempfile.TemporaryDirectory() as root:
+        for name, generate, cls in SOURCES:
+            path = Path(root) / name
+            (path / 'messages').mkdir(parents=True)
+            (path / 'files').mkdir()
+            generate(path, size, random.Random(seed))
+            results[name] = run(cls(path), size)
+
+    previous = deli.load(baseline) if baseline.exists() else None
+    if previous is not None and previous['size'] != size:
+        # the per-run overhead makes the throughput depend on the size
+        rich.print(f'[yellow]The baseline is for --size {previous["size"]}, skipping the comparison[/yellow]')
+        previous = None
+    regressions = report(results, previous and previous['results'], tolerance)
+    if save:
+        deli.save(dict(size=size, python=platform.python_version(), results=results), baseline, indent=2)
+        rich.print(f'Saved the baseline to {baseline}')
+    elif regressions:
+        rich.print(f'[red]{regressions} stage(s) are slower than the baseline[/red]')
+        raise typer.Exit(1)
+
+
+def run(interface, size):
+    result = {}
+
+    def measure(stage, func):
+        reset_peak_rss()
+        start = time.perf_counter()
+        value = func()
+        elapsed = time.perf_counter() - start
+        result[stage] = dict(
+            messages_per_second=round(size / elapsed, 1), peak_rss_mb=round(get_peak_rss() / 2 ** 20, 1),
+        )
+        return value
+
+    messages = measure('load', lambda: interface.load(CHAT_ID))
+    assert len(messages) == size, len(messages)
+    # the models are built lazily, which shouldn't count
+    for message in messages[:1]:
+        interface.convert(interface.validate(message)).model_dump_json()
+
+    messages = measure('validate', lambda: [interface.validate(x) for x in messages])
+    messages = measure('convert', lambda: [interface.convert(x) for x in messages])
+    measure('serialize', lambda: [x.model_dump_json() for x in messages])
+    return result
+
+
+def report(results, previous, tolerance):
+    table = Table('source', 'stage', 'messages/sec', 'peak RSS, MB', 'vs baseline')
+    regressions = 0
+    for name, stages in results.items():
+        for stage, value in stages.items():
+            change = ''
+            if previous and stage in previous.get(name, {}):
+                ratio = value['messages_per_second'] / previous[name][stage]['messages_per_second']
+                change = f'{ratio - 1:+.0%}'
+                if ratio < 1 - tolerance:
+                    regressions += 1
+                    change = f'[red]{change}[/red]'
+
+            table.add_row(
+                name, stage, f'{value["messages_per_second"]:,.0f}', f'{value["peak_rss_mb"]:,.0f}', change,
+            )
+
+    rich.print(table)
+    return regressions
+
+
+def reset_peak_rss():
+    # linux only: resets the "high water mark" of the process
+    try:
+        Path('/proc/self/clear_refs').write_text('5')
+    except OSError:
+        pass
+
+
+def get_peak_rss():
+    try:
+        for line in Path('/proc/self/status').read_text().splitlines():
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # the peak over the whole process, in KB on linux and in bytes on macos
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def sentence(rng, words=12):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, words)))
+
+
+# slack
+
+def generate_slack(root, size, rng):
+    deli.save([dict(id=CHAT_ID, name='general', updated=START)], root / 'conversations.json')
+    deli.save([dict(id=x, name=x, profile=dict(display_name=x)) for x in USERS], root / 'users.json')
+    deli.save({}, root / 'emojis.json')
+
+    messages = []
+    for i in range(size):
+        ts = f'{START + i}.000100'
+        if i % 10 == 0:
+            # bots repeat themselves
+            messages.append(dict(
+                type='message', subtype='bot_message', ts=ts, bot_id='B1', username='ci',
+                text=f'Build *{rng.choice(["passed", "failed"])}* for <https://ci.example.com|master>',
+                attachments=[dict(fallback='details', text=f'_{sentence(rng)}_', color='ff0000')],
+            ))
+            continue
+
+        text = sentence(rng)
+        message = dict(
+            type='message', ts=ts, user=rng.choice(USERS), text=text,
+            blocks=[dict(type='rich_text', block_id='b', elements=[dict(type='rich_text_section', elements=[
+                dict(type='text', text=text), dict(type='user', user_id=rng.choice(USERS)),
+                dict(type='text', text=' ' + sentence(rng), style=dict(bold=True)),
+            ])])],
+        )
+        if i % 7 == 0:
+            message['reactions'] = [dict(name='+1', count=2, users=rng.sample(USERS, 2))]
+        messages.append(message)
+
+    save_messages(messages, root / f'messages/{CHAT_ID}.json', lambda x: float(x['ts']))
+
+
+# telegram sdk
+
+def generate_telegram_sdk(root, size, rng):
+    deli.save([dict(
+        id=int(CHAT_ID), title='general', type={'@type': 'chatTypeBasicGroup', 'basic_group_id': 1},
+    )], root / 'chats.json')
+    deli.save([], root / 'users.json')
+    deli.save([], root / 'files/files.json')
+
+    messages = []
+    for i in range(size):
+        text = sentence(rng)
+        bold = len(text.split()[0])
+        message = dict(
+            TELEGRAM_MESSAGE, id=i + 1, chat_id=int(CHAT_ID), date=START + i,
+            sender_id={'@type': 'messageSenderUser', 'user_id': rng.randint(1, len(USERS))},
+            content={'@type': 'messageText', 'text': {'@type': 'formattedText', 'text': text, 'entities': [
+                {'@type': 'textEntity', 'offset': 0, 'length': bold, 'type': {'@type': 'textEntityTypeBold'}},
+            ]}},
+        )
+        if i % 7 == 0:
+            message['interaction_info'] = {
+                '@type': 'messageInteractionInfo', 'view_count': 0, 'forward_count': 0,
+                'reactions': {
+                    '@type': 'messageReactions', 'are_tags': False, 'paid_reactors': [],
+                    'can_get_added_reactions': True, 'reactions': [{
+                        '@type': 'messageReaction', 'type': {'@type': 'reactionTypeEmoji', 'emoji': '👍'},
+                        'total_count': 2, 'is_chosen': False, 'recent_sender_ids': [],
+                    }],
+                },
+            }
+        messages.append(message)
+
+    save_messages(messages, root / f'messages/{CHAT_ID}.json', lambda x: x['id'])
+
+
+TELEGRAM_MESSAGE = {
+    '@type': 'message', 'edit_date': 0, 'author_signature': '', 'auto_delete_in': 0, 'can_be_saved': True,
+    'contains_unread_mention': False, 'effect_id': 0, 'has_sensitive_content': False,
+    'has_timestamped_media': False, 'is_channel_post': False, 'is_from_offline': False, 'is_outgoing': False,
+    'is_pinned': False, 'is_topic_message': False, 'media_album_id': 0, 'message_thread_id': 0,
+    'restriction_reason': '', 'saved_messages_topic_id': 0, 'self_destruct_in': 0, 'sender_boost_count': 0,
+    'sender_business_bot_user_id': 0, 'unread_reactions': [], 'via_bot_user_id': 0,
+}
+
+
+# telegram export
+
+def generate_telegram_export(root, size, rng):
+    messages = []
+    for i in range(size):
+        user = rng.randint(1, len(USERS))
+        entities = [dict(type='plain', text=sentence(rng) + ' '), dict(type='bold', text=sentence(rng, 3))]
+        date = datetime.datetime.fromtimestamp(START + i)
+        messages.append(dict(
+            id=i + 1, type='message', date=date.isoformat(), date_unixtime=str(START + i),
+            from_=f'User {user}', from_id=f'user{user}', text=entities, text_entities=entities,
+        ))
+        messages[-1]['from'] = messages[-1].pop('from_')
+
+    deli.save(dict(id=int(CHAT_ID), name='general', type='private_group', messages=messages), root / f'{CHAT_ID}.json')
+
+
+SOURCES = [
+    ('slack', generate_slack, Slack),
+    ('telegram-sdk', generate_telegram_sdk, TelegramSDK),
+    ('telegram-export', generate_telegram_export, TelegramExport),
+]
+
+if __name__ == '__main__':
+    typer.run(main)
@@ -1,12 +1,18 @@
-from functools import cache
+import threading
+from contextlib import asynccontextmanager
+from typing import Annotated
 
-from fastapi import FastAPI, Request
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Query, Request
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.cors import CORSMiddleware
-from starlette.responses import Response
+from starlette.responses import Response, StreamingResponse
 
+from .cache import build_cache, load_cached, load_cached_window, load_participants, load_thread, stream_messages
 from .interface import Chat, ChatInfo, ChatInterface
-from .schema import AnyMessage
+from .schema import Agent, AnyMessage, detach_thread
+from .search import SearchHit, has_index, search as search_index, update_index, watch_index
 from .static import serve
+from .utils import select_window
 
 
 class TypeSchemaApp(FastAPI):
@@ -20,15 +26,24 @@ class TypeSchemaApp(FastAPI):
         return api
 
 
-app = TypeSchemaApp()
+@asynccontextmanager
+async def lifespan(_):
+    # the search index follows the histories as they change
+    stop = threading.Event()
+    threading.Thread(target=watch_index, args=(stop,), daemon=True).start()
+    yield
+    stop.set()
+
+
+app = TypeSchemaApp(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware, allow_origins=["*"], allow_methods=['*'],
 )
 
 
-@cache
-def get_agents(interface):
-    return ChatInterface.find(interface).gather_agents()
+@app.post('/reload')
+async def reload():
+    ChatInterface.reload()
 
 
 @app.get('/chats')
@@ -41,24 +56,96 @@ async def chats() -> list[Chat]:
 
 
 @app.get('/messages/{source}/{chat_id}')
-async def messages(source: str, chat_id: str) -> list[AnyMessage]:
+async def messages(source: str, chat_id: str, background: BackgroundTasks, before: str | None = None,
+                   after: str | None = None, limit: Annotated[int | None, Query(ge=1)] = None,
+                   stream: bool = False) -> list[AnyMessage]:
     chat = ChatInterface.find(source)
-    result = []
-    for message in chat.load(chat_id):
-        try:
-            message = chat.validate(message)
-        except Exception as e:
-            raise RuntimeError(message) from e
+    windowed = before is not None or after is not None or limit is not None
+    if stream and not windowed:
+        # the whole chat, with bounded memory
+        return StreamingResponse(to_json_array(stream_messages(chat, chat_id)), media_type='application/json')
+
+    try:
+        # only the window itself is read from the cache
+        lines = load_cached_window(chat, chat_id, before, after, limit)
+        if lines is None:
+            cached = load_cached(chat, chat_id)
+            if cached is not None:
+                lines = [line for _, line in select_window(list(zip(*cached)), lambda x: x[0], before, after, limit)]
+            elif windowed:
+                window = chat.load_window(chat_id, before=before, after=after, limit=limit)
+    except KeyError as e:
+        raise HTTPException(404, f'Unknown message: {e.args[0]}') from e
+
+    if lines is None and not windowed:
+        # the response and the cache come from a single conversion
+        lines = stream_messages(chat, chat_id)
+    elif lines is None:
+        # the whole chat is converted only once, after the response is sent
+        background.add_task(build_cache, chat, chat_id)
+        # the threads are served separately
+        window = (detach_thread(chat.process(message))[0] for message in window)
+        if not stream:
+            return list(window)
+
+        lines = (message.model_dump_json().encode() for message in window)
+
+    if stream:
+        return StreamingResponse(to_json_array(lines), media_type='application/json')
+    return Response(b'[' + b','.join(lines) + b']', media_type='application/json')
+
+
+def to_json_array(lines):
+    yield b'['
+    for i, line in enumerate(lines):
+        if i:
+            yield b','
+        yield line
+    yield b']'
+
+
+@app.get('/thread/{source}/{chat_id}/{message_id}')
+async def thread(source: str, chat_id: str, message_id: str, background: BackgroundTasks) -> list[AnyMessage]:
+    chat = ChatInterface.find(source)
+    try:
+        cached = load_thread(chat, chat_id, message_id)
+    except KeyError as e:
+        raise HTTPException(404, f'Unknown message: {e.args[0]}') from e
+    if cached is not None:
+        return Response(cached, media_type='application/json')
 
-        message = chat.convert(message)
-        result.append(message)
+    background.add_task(build_cache, chat, chat_id)
+    for message in chat.iterate(chat_id):
+        if chat.get_message_id(message) == message_id:
+            return chat.process(message).thread
 
-    return result
+    raise HTTPException(404, f'Unknown message: {message_id}')
+
+
+@app.get('/search')
+async def search(background: BackgroundTasks, q: str, source: str | None = None, chat_id: str | None = None,
+                 limit: Annotated[int, Query(ge=1, le=500)] = 50) -> list[SearchHit]:
+    if not has_index():
+        # the first search can't be answered until the index is built
+        await run_in_threadpool(update_index, True)
+    else:
+        # the chats that changed since the last update are indexed after the response is sent
+        background.add_task(update_index)
+    return search_index(q, source, chat_id, limit)
 
 
 @app.get('/info/{source}/{chat_id}')
 async def info(source: str, chat_id: str) -> ChatInfo:
-    return ChatInfo(agents=get_agents(source))
+    interface = ChatInterface.find(source)
+    # the participants might have to wait for the cache, which shouldn't block the other requests
+    participants = await run_in_threadpool(load_participants, interface, chat_id)
+    return ChatInfo(agents=interface.find_agents(participants))
+
+
+@app.get('/agents/{source}')
+async def agents(source: str, ids: Annotated[list[str], Query()]) -> list[Agent]:
+    """ Looks up the agents that are missing from the chat info """
+    return ChatInterface.find(source).find_agents(ids)
 
 
 @app.get('/files/{source}/{identifier}', response_class=Response, include_in_schema=False)
@@ -7,5 +7,7 @@ app = typer.Typer(pretty_exceptions_show_locals=False)
 def main():
     from .slack import backup  # noqa
     from .telegram_sdk import backup  # noqa
+    from .telegram_export import normalizer  # noqa
+    from . import repack, validate  # noqa
 
     app()
@@ -0,0 +1,312 @@
+"""
+An on-disk cache of the converted messages.
+
+Each chat is stored as json lines - one converted message per line - along with a header, which contains the message
+ids, the ids of the agents referenced in the chat and the signature of the source files. This way a window of messages
+can be served without parsing anything.
+
+The threads are stored in a separate file, one json array per line, and the timeline only carries their summaries.
+The header keeps the position of each thread in that file.
+
+If the source provides message keys, the chat also gets an offset index in the same layout as the storage's one, see
+`storage.MessageIndex`. The index has its own small header, so a window can be sliced from the memory-mapped lines
+without reading the header or the rest of the lines.
+"""
+import hashlib
+import json
+import os
+import struct
+import threading
+from contextlib import contextmanager
+
+from .schema import detach_thread
+from .settings import settings
+from .storage import INDEX_RECORD, MessageIndex
+from .utils import map_file, select_indexed_window
+
+
+# bump this whenever the conversion changes
+VERSION = 3
+# the digest of the cache key, the signature of the lines file, the number of messages and whether the keys are sorted
+INDEX_HEADER = struct.Struct('<16sqqq?')
+
+# the chats whose cache is being built, along with an event that is set when it's done
+_building = {}
+_lock = threading.Lock()
+
+
+def load_cached(interface, chat_id) -> tuple[list[str], list[bytes]] | None:
+    _, lines_path, _ = _get_paths(interface, chat_id)
+    try:
+        header = _read_header(interface, chat_id)
+        if header is None:
+            return None
+
+        lines = lines_path.read_bytes().splitlines()
+    except (OSError, ValueError, KeyError):
+        return None
+
+    ids = header['ids']
+    if len(ids) != len(lines):
+        return None
+    return ids, lines
+
+
+def load_cached_window(interface, chat_id, before=None, after=None, limit=None) -> list[bytes] | None:
+    """
+    The serialized messages between the `after` and `before` cursors, see `select_window`.
+    Only the window itself is read. Returns None if the chat has no valid index.
+    """
+
+    def locate(message_id):
+        try:
+            key = interface.get_message_key(message_id)
+        except ValueError:
+            return None
+
+        for i in index.find(key):
+            # different ids might share the same key
+            if json.loads(index.read_lines(i, i + 1)[0])['id'] == message_id:
+                return i
+
+    with _open_index(interface, chat_id) as index:
+        if index is None:
+            return None
+        return select_indexed_window(index, locate, before, after, limit, serialized=True)
+
+
+def iterate_cached(interface, chat_id):
+    """ Lazily reads the cached messages, without loading the whole file. Returns None if the cache is stale """
+    _, lines_path, _ = _get_paths(interface, chat_id)
+    try:
+        if _read_header(interface, chat_id) is None:
+            return None
+        file = open(lines_path, 'rb')
+    except (OSError, ValueError, KeyError):
+        return None
+
+    def generate():
+        with file:
+            for line in file:
+                yield line.rstrip(b'\n')
+
+    return generate()
+
+
+def load_participants(interface, chat_id) -> list[str]:
+    """ The ids of the agents referenced in the chat: senders, mentions, reactions etc. """
+    header = _load_header(interface, chat_id)
+    if header is None:
+        build_cache(interface, chat_id, wait=True)
+        header = _load_header(interface, chat_id)
+
+    # the chat changed in the meantime
+    if header is None:
+        agents = set()
+        for line in _convert(interface, chat_id):
+            _gather_agents(json.loads(line), agents)
+        return sorted(agents)
+
+    return header['agents']
+
+
+def load_thread(interface, chat_id, message_id) -> bytes | None:
+    """ The serialized thread of the message. Returns None if the cache is stale """
+    header = _load_header(interface, chat_id)
+    if header is None:
+        return None
+
+    if message_id not in header['threads']:
+        if message_id not in header['ids']:
+            raise KeyError(message_id)
+        return b'[]'
+
+    _, _, threads_path = _get_paths(interface, chat_id)
+    start, size = header['threads'][message_id]
+    try:
+        with open(threads_path, 'rb') as file:
+            file.seek(start)
+            return file.read(size)
+    except OSError:
+        return None
+
+
+def stream_messages(interface, chat_id):
+    """ Yields the serialized messages of the whole chat, filling the cache along the way """
+    lines = iterate_cached(interface, chat_id)
+    if lines is None:
+        lines = _convert(interface, chat_id)
+    yield from lines
+
+
+def build_cache(interface, chat_id, wait: bool = False):
+    """ Does nothing if the cache is already being built, or waits for that build to finish if `wait` is True """
+    building = _start_building(interface, chat_id)
+    if building is not None:
+        if wait:
+            building.wait()
+        return
+
+    for _ in _write_cache(interface, chat_id):
+        pass
+
+
+def _convert(interface, chat_id):
+    # somebody else is already writing the cache, but the lines are needed right now
+    if _start_building(interface, chat_id) is not None:
+        for message in interface.iterate(chat_id):
+            message, _ = detach_thread(interface.process(message))
+            yield message.model_dump_json().encode()
+        return
+
+    yield from _write_cache(interface, chat_id)
+
+
+def _start_building(interface, chat_id) -> threading.Event | None:
+    """ Registers a new build of the cache. Returns the event of the running build instead, if there is one """
+    name = interface.name, chat_id
+    with _lock:
+        building = _building.get(name)
+        if building is None:
+            _building[name] = threading.Event()
+        return building
+
+
+def _write_cache(interface, chat_id):
+    """ Converts the chat and writes the cache. The build must be registered by `_start_building` """
+    name = interface.name, chat_id
+    header_path, lines_path, threads_path = _get_paths(interface, chat_id)
+    index_path = _get_index_path(interface, chat_id)
+    try:
+        # the key must be computed before loading, so that concurrent changes will invalidate the cache
+        key = _get_key(interface, chat_id)
+        header_path.parent.mkdir(parents=True, exist_ok=True)
+        ids, agents, threads, records = [], set(), {}, []
+        with open(_tmp(lines_path), 'wb') as file, open(_tmp(threads_path), 'wb') as threads_file:
+            for message in interface.iterate(chat_id):
+                message, thread = detach_thread(interface.process(message))
+                line = message.model_dump_json().encode()
+                ids.append(message.id)
+                records.append((interface.get_message_key(message.id), file.tell(), len(line)))
+                _gather_agents(json.loads(line), agents)
+                if thread:
+                    body = b'[' + b','.join(x.model_dump_json().encode() for x in thread) + b']'
+                    threads[message.id] = threads_file.tell(), len(body)
+                    threads_file.write(body + b'\n')
+                    _gather_agents(json.loads(body), agents)
+
+                file.write(line + b'\n')
+                yield line
+
+        with open(_tmp(header_path), 'w') as file:
+            json.dump(dict(key=key, ids=ids, agents=sorted(agents), threads=threads), file)
+
+        # the index validates itself against the lines, whose signature doesn't change when they are moved
+        indexed = all(x[0] is not None for x in records)
+        if indexed:
+            _save_index(_tmp(index_path), key, os.stat(_tmp(lines_path)), records)
+
+        # the header goes last: it's the one that validates the cache
+        os.replace(_tmp(lines_path), lines_path)
+        os.replace(_tmp(threads_path), threads_path)
+        if indexed:
+            os.replace(_tmp(index_path), index_path)
+        os.replace(_tmp(header_path), header_path)
+
+    finally:
+        _tmp(lines_path).unlink(missing_ok=True)
+        _tmp(threads_path).unlink(missing_ok=True)
+        _tmp(index_path).unlink(missing_ok=True)
+        with _lock:
+            _building.pop(name).set()
+
+
+def _gather_agents(value, agents: set):
+    if isinstance(value, list):
+        for x in value:
+            _gather_agents(x, agents)
+
+    elif isinstance(value, dict):
+        for name, x in value.items():
+            # senders, authors of shared messages, mentions and the targets of system events
+            if name in ('agent_id', 'user_id', 'by') and isinstance(x, str):
+                agents.add(x)
+            # participants of system events and reactions
+            elif name in ('agents', 'users') and isinstance(x, list):
+                agents.update(x)
+            else:
+                _gather_agents(x, agents)
+
+
+def _save_index(path, key, stat, records):
+    keys = [x[0] for x in records]
+    ordered = all(a < b for a, b in zip(keys, keys[1:]))
+    with open(path, 'wb') as file:
+        file.write(INDEX_HEADER.pack(_digest(key), stat.st_mtime_ns, stat.st_size, len(records), ordered))
+        for record in records:
+            file.write(INDEX_RECORD.pack(*record))
+
+
+@contextmanager
+def _open_index(interface, chat_id):
+    _, lines_path, _ = _get_paths(interface, chat_id)
+    try:
+        lines = open(lines_path, 'rb')
+        index = open(_get_index_path(interface, chat_id), 'rb')
+    except OSError:
+        yield None
+        return
+
+    with lines, index:
+        header = index.read(INDEX_HEADER.size)
+        if len(header) != INDEX_HEADER.size:
+            yield None
+            return
+
+        digest, mtime, size, count, ordered = INDEX_HEADER.unpack(header)
+        stat = os.fstat(lines.fileno())
+        valid = digest == _digest(_get_key(interface, chat_id)) and [stat.st_mtime_ns, stat.st_size] == [mtime, size]
+        if not valid or os.fstat(index.fileno()).st_size < INDEX_HEADER.size + count * INDEX_RECORD.size:
+            yield None
+            return
+
+        with map_file(index) as index_map, map_file(lines) as lines_map:
+            yield MessageIndex(dict(count=count, sorted=ordered), index_map, lines_map, INDEX_HEADER.size)
+
+
+def _digest(key):
+    return hashlib.md5(json.dumps(key, sort_keys=True).encode()).digest()
+
+
+def _load_header(interface, chat_id):
+    try:
+        return _read_header(interface, chat_id)
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _read_header(interface, chat_id):
+    header_path, _, _ = _get_paths(interface, chat_id)
+    header = json.loads(header_path.read_bytes())
+    if header['key'] == _get_key(interface, chat_id):
+        return header
+
+
+def _get_key(interface, chat_id):
+    return dict(
+        version=VERSION, root=str(interface.root), base_url=settings.base_url,
+        signature=interface.get_signature(chat_id),
+    )
+
+
+def _get_paths(interface, chat_id):
+    root = settings.cache / 'messages' / interface.name
+    return root / f'{chat_id}.json', root / f'{chat_id}.jsonl', root / f'{chat_id}.threads.jsonl'
+
+
+def _get_index_path(interface, chat_id):
+    return settings.cache / 'messages' / interface.name / f'{chat_id}.idx'
+
+
+def _tmp(path):
+    return path.with_stem('tmp-' + path.stem)
@@ -1,15 +1,26 @@
 from __future__ import annotations
 
+import datetime
+import threading
+from functools import cached_property
 from pathlib import Path
 from typing import Iterable
 
+import deli
 from pydantic import BaseModel
 
 from .schema import Agent, AnyMessage
 from .settings import settings
+from .storage import get_signature, open_index
+from .utils import file_signature, save_backup, select_indexed_window, select_window
 
 
 _registry = {}
+# the interfaces live as long as the process, so that their indices are shared between requests
+_instances = {}
+_lock = threading.Lock()
+# the list of chats, maintained by the backup commands
+CHATS_INDEX = 'chats-index.json'
 
 
 class ChatInterface:
@@ -17,21 +28,118 @@ class ChatInterface:
 
     def __init__(self, root: str | Path):
         self.root = Path(root)
+        self._signature = self._get_dependencies_signature()
 
     def load(self, x):
         pass
 
+    def get_path(self, x) -> Path:
+        """ The file containing the messages of the chat `x` """
+
+    def get_signature(self, x):
+        """ Changes whenever the converted messages of the chat `x` might change """
+        return [get_signature(self.get_path(x)), *self._get_dependencies_signature()]
+
+    @property
+    def dependencies(self) -> list[Path]:
+        """ Files that the conversion depends on, besides the messages themselves """
+        return []
+
+    def iterate(self, x):
+        """ Yields the raw messages of the chat `x`. Subclasses may override this to avoid loading all of them """
+        yield from self.load(x)
+
+    def load_window(self, x, before: str | None = None, after: str | None = None, limit: int | None = None):
+        return select_window(self.load(x), self.get_message_id, before, after, limit)
+
+    def get_message_id(self, msg) -> str:
+        """ The id of a raw message, the same as the one of its converted `AnyMessage` """
+
+    def get_message_key(self, message_id: str) -> float:
+        """ The key of the message in the storage's offset index """
+
+    def _load_indexed_window(self, x, before, after, limit):
+        """ Reads only the window itself from the storage's offset index. Returns None if the chat isn't indexed """
+
+        def locate(message_id):
+            try:
+                key = self.get_message_key(message_id)
+            except ValueError:
+                return None
+
+            for i in index.find(key):
+                # different ids might share the same key
+                if self.get_message_id(index.read(i, i + 1)[0]) == message_id:
+                    return i
+
+        with open_index(self.get_path(x)) as index:
+            if index is None:
+                return None
+            return select_indexed_window(index, locate, before, after, limit)
+
     def validate(self, msg):
         pass
 
     def convert(self, msg) -> AnyMessage:
         pass
 
+    def process(self, msg) -> AnyMessage:
+        try:
+            msg = self.validate(msg)
+        except Exception as e:
+            raise RuntimeError(msg) from e
+
+        return self.convert(msg)
+
     def gather_agents(self):
         pass
 
+    @property
+    def agents_dependencies(self) -> list[Path]:
+        """ Files that the agents are gathered from """
+        return []
+
+    def get_agents(self) -> list[Agent]:
+        return list(self._get_agents().values())
+
+    def find_agents(self, ids: Iterable[str]) -> list[Agent]:
+        """ The known agents among `ids` """
+        agents = self._get_agents()
+        return [agents[x] for x in ids if x in agents]
+
+    def _get_agents(self) -> dict[str, Agent]:
+        """ The cached `gather_agents`, which is refreshed whenever any of `agents_dependencies` changes """
+        signature = [file_signature(path) for path in self.agents_dependencies]
+        cached = self.__dict__.get('_agents')
+        if cached is None or cached[0] != signature:
+            cached = self._agents = signature, {agent.id: agent for agent in self.gather_agents()}
+        return cached[1]
+
+    @property
+    def chats_dependencies(self) -> list[Path]:
+        """ Files that the chats index is built from """
+        return []
+
     def gather_chats(self) -> Iterable[ChatDescription]:
-        pass
+        """
+        Reads the chats from the index. Backups without an index are scanned instead, and the result is kept until any
+        of `chats_dependencies` changes
+        """
+        path = self.root / CHATS_INDEX
+        if path.exists():
+            return [ChatDescription.model_validate(x) for x in deli.load(path)]
+
+        signature = [file_signature(path) for path in self.chats_dependencies]
+        cached = self.__dict__.get('_chats')
+        if cached is None or cached[0] != signature:
+            cached = self._chats = signature, list(self.build_chats_index())
+        return cached[1]
+
+    def build_chats_index(self) -> list[ChatDescription]:
+        """ Gathers the chats, along with their stats, from the whole backup """
+
+    def save_chats_index(self):
+        save_backup([x.model_dump(mode='json') for x in self.build_chats_index()], self.root / CHATS_INDEX)
 
     def get_chats(self) -> list[Chat]:
         return [Chat(**x.model_dump(), source=self.name) for x in self.gather_chats()]
@@ -55,6 +163,25 @@ class ChatInterface:
     def resolve(self, file_id):
         pass
 
+    # caching
+
+    def invalidate(self):
+        """ Drops all the cached indices, so that they will be rebuilt on the next access """
+        for cls in type(self).__mro__:
+            for name, value in vars(cls).items():
+                if isinstance(value, cached_property):
+                    self.__dict__.pop(name, None)
+
+    def refresh(self):
+        """ Invalidates the cached indices if any of the files they depend on have changed """
+        signature = self._get_dependencies_signature()
+        if signature != self._signature:
+            self.invalidate()
+            self._signature = signature
+
+    def _get_dependencies_signature(self):
+        return [file_signature(path) for path in self.dependencies]
+
     # subclasses
 
     def __init_subclass__(cls, **kwargs):
@@ -62,10 +189,25 @@ class ChatInterface:
 
     @classmethod
     def find(cls, name) -> ChatInterface:
-        return cls.all()[name]
+        interface = cls.all()[name]
+        interface.refresh()
+        return interface
 
     @classmethod
     def all(cls) -> dict[str, ChatInterface]:
+        with _lock:
+            if not _instances:
+                _instances.update(cls._create_all())
+            return _instances
+
+    @classmethod
+    def reload(cls):
+        """ Drops all the interfaces, so that they will be recreated on the next access """
+        with _lock:
+            _instances.clear()
+
+    @staticmethod
+    def _create_all():
         # TODO: fixme
         from .slack.interface import Slack
         from .telegram_export.interface import TelegramExport
@@ -89,6 +231,8 @@ class ChatInfo(BaseModel):
 class ChatDescription(BaseModel):
     id: str
     name: str
+    count: int | None = None
+    last_activity: datetime.datetime | None = None
 
 
 class Chat(ChatDescription):
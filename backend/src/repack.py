@@ -0,0 +1,36 @@
+from pathlib import Path
+
+import rich
+import typer
+from tqdm.auto import tqdm
+
+from .backup import app
+from .storage import StorageFormat, convert_messages, get_manifest, iterate_messages
+
+
+@app.command()
+def repack(storage: Path, format: StorageFormat = StorageFormat.blocks, check: bool = True):
+    """ Converts all the message histories in the storage to the given format """
+    # old histories without a manifest are converted on their first sync
+    manifests = (storage / 'messages').glob('*.manifest.json')
+    histories = sorted(x.with_name(x.name.removesuffix('.manifest.json') + '.json') for x in manifests)
+    converted = skipped = 0
+    before = after = 0
+    for path in tqdm(histories, desc='Repacking'):
+        size = get_manifest(path)['size']
+        expected = list(iterate_messages(path)) if check else None
+        if not convert_messages(path, format):
+            skipped += 1
+            continue
+
+        if check and list(iterate_messages(path)) != expected:
+            rich.print(f'[red]The history {path} changed after the conversion[/red]')
+            raise typer.Exit(1)
+
+        converted += 1
+        before += size
+        after += get_manifest(path)['size']
+
+    rich.print(f'Converted {converted} chat(s), {skipped} already in the "{format}" format')
+    if converted:
+        rich.print(f'Size: {before / 2 ** 20:,.1f} MB -> {after / 2 ** 20:,.1f} MB')
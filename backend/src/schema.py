@@ -15,6 +15,12 @@ class Reaction(NoExtra):
     users: list[str]
 
 
+class ThreadInfo(NoExtra):
+    count: int
+    last_reply: datetime.datetime
+    agents: list[AgentID]
+
+
 class Base(NoExtra):
     type: str
     id: str
@@ -22,6 +28,8 @@ class Base(NoExtra):
     thread: list[AnyMessage]
     elements: list[Element]
     reactions: list[Reaction]
+    # the summary of the `thread`, when it is served separately
+    replies: ThreadInfo | None = None
 
 
 class Agent(NoExtra):
@@ -81,3 +89,19 @@ class AgentMessage(Base):
 
 type SystemMessage = Union[BaseSystemMessage, *BaseSystemMessage.__subclasses__()]
 type AnyMessage = AgentMessage | SystemMessage
+
+
+def detach_thread(message: AnyMessage) -> tuple[AnyMessage, list[AnyMessage]]:
+    """ Replaces the thread with its summary """
+    thread = message.thread
+    if not thread:
+        return message, thread
+
+    agents = []
+    for reply in thread:
+        agent = getattr(reply, 'agent_id', None)
+        if agent is not None and agent not in agents:
+            agents.append(agent)
+
+    replies = ThreadInfo(count=len(thread), last_reply=max(x.timestamp for x in thread), agents=agents)
+    return message.model_copy(update=dict(thread=[], replies=replies)), thread
@@ -0,0 +1,205 @@
+"""
+A full-text index of all the messages, stored in sqlite.
+
+The index is built from the converted messages, one chat at a time. Each chat is stored along with the signature of
+its history, so that only the chats that changed since the last update are indexed again. The server keeps the index
+up to date in the background, see `watch_index`.
+"""
+import json
+import sqlite3
+import threading
+import traceback
+from contextlib import closing
+
+from pydantic import BaseModel
+
+from .cache import load_thread, stream_messages
+from .interface import ChatInterface
+from .settings import settings
+from .storage import get_signature
+
+
+# bump this whenever the indexed text changes
+VERSION = 1
+
+_updating = threading.Lock()
+# the chats that couldn't be indexed, along with the keys they failed at, so that they aren't retried until they change
+_failed = {}
+
+
+class SearchHit(BaseModel):
+    source: str
+    chat_id: str
+    message_id: str
+    # the id of the top-level message, if the hit is inside a thread
+    thread_id: str | None
+    snippet: str
+
+
+def search(query: str, source: str | None = None, chat_id: str | None = None, limit: int = 50) -> list[SearchHit]:
+    query = _to_fts(query)
+    if not query:
+        return []
+
+    conditions, params = ['texts MATCH ?'], [query]
+    if source is not None:
+        conditions.append('chats.source = ?')
+        params.append(source)
+    if chat_id is not None:
+        conditions.append('chats.chat_id = ?')
+        params.append(chat_id)
+
+    with closing(_connect()) as db:
+        rows = db.execute(
+            "SELECT chats.source, chats.chat_id, entries.message_id, entries.thread_id, "
+            "snippet(texts, 0, '', '', '…', 16) FROM texts "
+            "JOIN entries ON entries.id = texts.rowid JOIN chats ON chats.id = entries.chat "
+            f"WHERE {' AND '.join(conditions)} ORDER BY texts.rank LIMIT ?",
+            [*params, limit],
+        ).fetchall()
+
+    return [
+        SearchHit(source=source, chat_id=chat_id, message_id=message_id, thread_id=thread_id, snippet=snippet)
+        for source, chat_id, message_id, thread_id, snippet in rows
+    ]
+
+
+def has_index() -> bool:
+    """ Whether the index was ever built """
+    with closing(_connect()) as db:
+        return db.execute('SELECT 1 FROM chats LIMIT 1').fetchone() is not None
+
+
+def watch_index(stop: threading.Event):
+    """ Updates the index right away, and then every `settings.search_interval` seconds, until `stop` is set """
+    while not stop.is_set():
+        try:
+            update_index()
+        except Exception:
+            # e.g. a broken chats list, which might get fixed by the next sync
+            traceback.print_exc()
+        stop.wait(settings.search_interval)
+
+
+def update_index(wait: bool = False):
+    """
+    Indexes the chats that changed since the last update.
+    If an update is already running, waits for it to finish if `wait` is True, and does nothing otherwise.
+    """
+    if not _updating.acquire(blocking=wait):
+        return
+
+    try:
+        with closing(_connect()) as db:
+            indexed = {
+                (source, chat_id): key for source, chat_id, key in db.execute('SELECT source, chat_id, key FROM chats')
+            }
+            current = set()
+            for interface in ChatInterface.all().values():
+                for chat in interface.get_chats():
+                    name = interface.name, chat.id
+                    current.add(name)
+                    key = json.dumps(_get_key(interface, chat.id))
+                    if indexed.get(name) == key or _failed.get(name) == key:
+                        continue
+
+                    try:
+                        _index_chat(db, interface, chat.id, key)
+                        _failed.pop(name, None)
+                    except Exception:
+                        # a broken chat shouldn't stop the other ones from being indexed
+                        traceback.print_exc()
+                        _failed[name] = key
+
+            # the chats that are gone
+            with db:
+                for name in set(indexed) - current:
+                    _drop_chat(db, *name)
+
+    finally:
+        _updating.release()
+
+
+def _index_chat(db, interface, chat_id, key):
+    rows, threads = [], []
+    for line in stream_messages(interface, chat_id):
+        message = json.loads(line)
+        rows.extend(_get_rows(message, None))
+        if message.get('replies'):
+            threads.append(message['id'])
+
+    # the threads are cached separately
+    for message_id in threads:
+        thread = load_thread(interface, chat_id, message_id)
+        # the cache is being rebuilt, the chat will be indexed on the next update
+        if thread is None:
+            return
+        for reply in json.loads(thread):
+            rows.extend(_get_rows(reply, message_id))
+
+    # a single transaction, so that searches never see a half-indexed chat
+    with db:
+        _drop_chat(db, interface.name, chat_id)
+        chat = db.execute(
+            'INSERT INTO chats (source, chat_id, key) VALUES (?, ?, ?)', (interface.name, chat_id, key)
+        ).lastrowid
+        for text, message_id, thread_id in rows:
+            entry = db.execute(
+                'INSERT INTO entries (chat, message_id, thread_id) VALUES (?, ?, ?)', (chat, message_id, thread_id)
+            ).lastrowid
+            db.execute('INSERT INTO texts (rowid, text) VALUES (?, ?)', (entry, text))
+
+
+def _drop_chat(db, source, chat_id):
+    row = db.execute('SELECT id FROM chats WHERE source = ? AND chat_id = ?', (source, chat_id)).fetchone()
+    if row is not None:
+        db.execute('DELETE FROM texts WHERE rowid IN (SELECT id FROM entries WHERE chat = ?)', row)
+        db.execute('DELETE FROM entries WHERE chat = ?', row)
+        db.execute('DELETE FROM chats WHERE id = ?', row)
+
+
+def _get_rows(message, thread_id):
+    text = ' '.join(_get_text([message['elements'], message.get('shared', [])]))
+    if text.strip():
+        yield text, message['id'], thread_id
+
+
+def _get_text(value):
+    """ Yields the contents of all the `Text` elements """
+    if isinstance(value, list):
+        for x in value:
+            yield from _get_text(x)
+
+    elif isinstance(value, dict):
+        if value.get('type') == 'text':
+            yield value['text']
+        else:
+            for x in value.values():
+                yield from _get_text(x)
+
+
+def _to_fts(query: str):
+    # every word is quoted, so that the fts syntax can't break the query
+    return ' '.join('"{}"'.format(word.replace('"', '""')) for word in query.split())
+
+
+def _get_key(interface, chat_id):
+    # the text doesn't depend on the files, so only the history itself is tracked
+    return dict(version=VERSION, root=str(interface.root), signature=get_signature(interface.get_path(chat_id)))
+
+
+def _connect():
+    settings.cache.mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(settings.cache / 'search.sqlite', timeout=30)
+    # readers don't block the writer
+    db.execute('PRAGMA journal_mode=WAL')
+    db.executescript('''
+        CREATE TABLE IF NOT EXISTS chats (
+            id INTEGER PRIMARY KEY, source TEXT, chat_id TEXT, key TEXT, UNIQUE (source, chat_id)
+        );
+        CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY, chat INTEGER, message_id TEXT, thread_id TEXT);
+        CREATE INDEX IF NOT EXISTS entries_chat ON entries (chat);
+        -- the rowid is the id of the entry
+        CREATE VIRTUAL TABLE IF NOT EXISTS texts USING fts5(text, tokenize = 'unicode61 remove_diacritics 2');
+    ''')
+    return db
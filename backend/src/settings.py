@@ -8,6 +8,9 @@ class Settings(BaseSettings):
     telegram_export: Path | None = None
     telegram_sdk: Path | None = None
     base_url: str | None = None
+    cache: Path = Path(__file__).resolve().parent.parent / '.cache'
+    # how often to look for changed histories to add to the search index, in seconds
+    search_interval: float = 30
 
 
 settings = Settings(_env_file=Path(__file__).resolve().parent.parent / '.env')
@@ -1,15 +1,20 @@
 import time
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from enum import StrEnum
 from pathlib import Path
 
 import requests
 import rich
 from pydantic_settings import BaseSettings
+from requests.adapters import HTTPAdapter
 from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
 
 from ..backup import app
-from ..utils import load_backup, nested_rich, save_backup
+from ..storage import append_messages, get_last_key, iterate_messages, load_messages, open_index, save_messages
+from ..utils import TokenBucket, load_backup, nested_rich, save_backup
+from .interface import Slack
 
 
 class SlackSettings(BaseSettings):
@@ -31,16 +36,25 @@ class ChatContent(StrEnum):
 
 
 TYPE_MAPPING = {'multi_personal': 'mpim', 'personal': 'im'}
+# https://api.slack.com/apis/rate-limits
+TIERS = {
+    'conversations_list': 2, 'users_list': 2,
+    'conversations_history': 3, 'conversations_replies': 3, 'files_list': 3,
+}
+REQUESTS_PER_MINUTE = {1: 1, 2: 20, 3: 50, 4: 100}
+_limiters = {}
 
 
 @app.command()
-def slack(storage: Path, types: list[ChatType] = tuple(ChatType), content: list[ChatContent] = tuple(ChatContent)):
+def slack(storage: Path, types: list[ChatType] = tuple(ChatType), content: list[ChatContent] = tuple(ChatContent),
+          workers: int = 8, thread_days: int = 30):
     settings = SlackSettings(_env_file=storage / '.env')
     client = WebClient(token=settings.token)
-    update(client, storage, types, content)
+    update(client, storage, types, content, workers, thread_days)
 
 
-def update(client: WebClient, storage: Path, conv_types, content_types):
+def update(client: WebClient, storage: Path, conv_types, content_types, workers: int = 8, thread_days: int = 30):
+    """ `thread_days` - how far back to look for threads with new replies """
     update_conversations, update_messages, update_users, update_files = (x in content_types for x in ChatContent)
 
     conversations_path = storage / 'conversations.json'
@@ -54,39 +68,71 @@ def update(client: WebClient, storage: Path, conv_types, content_types):
         old = _update(conversations, old)
         save_backup(old, conversations_path)
 
+    def fetch_replies(channel, ts):
+        return sorted(paginated(
+            client.conversations_replies, unpack='messages', channel=channel, ts=ts, limit=200
+        ), key=message_key)
+
+    def fetch(conversation):
+        channel = conversation['id']
+        path = storage / f'messages/{channel}.json'
+        last = get_last_key(path, message_key)
+        oldest = last
+        # the recent threads might have new replies, so the recent messages are requested again
+        if last is not None and thread_days:
+            oldest = min(last, time.time() - thread_days * 24 * 60 * 60)
+
+        added, recent = [], {}
+        for message in progress(paginated(
+                client.conversations_history, unpack='messages', channel=channel,
+                oldest=None if oldest is None else format_ts(oldest), limit=200, include_all_metadata=True,
+        ), leave=False, desc=conversation.get('name') or conversation.get('user') or channel):
+            if last is None or message_key(message) > last:
+                added.append(message)
+            elif message.get('reply_count', 0) > 0:
+                recent[message['ts']] = message
+
+        assert len(added) == len({x['ts'] for x in added})
+        if recent:
+            recent = {
+                x['ts']: recent[x['ts']] for x in load_tail(path, oldest)
+                if x['ts'] in recent and not is_thread_current(x, recent[x['ts']])
+            }
+
+        # the threads are fetched concurrently, and replace the stored messages in place
+        threads = [x for x in added if x.get('reply_count', 0) > 0] + list(recent.values())
+        futures = {threads_pool.submit(fetch_replies, channel, x['ts']): x for x in threads}
+        for future in as_completed(futures):
+            futures[future]['replies'] = future.result()
+
+        added = sorted(added, key=message_key)
+        if recent:
+            # the refreshed threads replace the stored messages with the same key
+            save_messages([*iterate_messages(path), *recent.values(), *added], path, message_key)
+        elif added:
+            append_messages(added, path, message_key)
+
+    if update_messages:
+        with (
+            nested_rich() as progress,
+            ThreadPoolExecutor(workers) as pool,
+            ThreadPoolExecutor(workers) as threads_pool,
+        ):
+            futures = [pool.submit(fetch, conversation) for conversation in conversations]
+            try:
+                for future in progress(as_completed(futures), desc='Processing messages', total=len(futures)):
+                    future.result()
+            except BaseException:
+                pool.shutdown(cancel_futures=True)
+                raise
+
+    if update_conversations or update_messages:
+        Slack(storage).save_chats_index()
+
     profiles = {}
-    if update_messages or update_users:
-        with nested_rich() as progress:
-            for conversation in progress(conversations, desc='Processing messages'):
-                channel = conversation['id']
-                path = storage / f'messages/{channel}.json'
-                messages = load_backup(path)
-
-                if update_messages:
-                    oldest = max((x['ts'] for x in messages), key=float, default=None)
-                    added = False
-                    for message in progress(paginated(
-                            client.conversations_history, unpack='messages',
-                            channel=channel, oldest=oldest, limit=200, include_all_metadata=True,
-                    ), leave=False, desc=conversation.get('name') or conversation.get('user') or channel):
-                        messages.append(message)
-                        added = True
-                        if message.get('reply_count', 0) > 0:
-                            assert 'replies' not in message
-                            message['replies'] = sorted(paginated(
-                                client.conversations_replies, unpack='messages', channel=channel, ts=message['ts'],
-                                limit=200
-                            ), key=lambda x: float(x['ts']))
-
-                    if added:
-                        assert len(messages) == len({x['ts'] for x in messages})
-                        messages = sorted(messages, key=lambda x: float(x['ts']))
-                        save_backup(messages, path)
-                        time.sleep(0.5)
-
-                    time.sleep(0.5)
-
-                gather_profiles_(messages, profiles)
+    if update_users:
+        for conversation in conversations:
+            gather_profiles_(iterate_messages(storage / f'messages/{conversation["id"]}.json'), profiles)
 
     users_path = storage / 'users.json'
     users = load_backup(users_path)
@@ -113,11 +159,11 @@ def update(client: WebClient, storage: Path, conv_types, content_types):
 
     if update_files:
         visited = set()
-        errors, no_url = [], []
-        with nested_rich() as progress:
+        errors, no_url, downloads = [], [], {}
+        with nested_rich() as progress, make_session(client, workers) as session, ThreadPoolExecutor(workers) as pool:
             for file in progress(paginated(
                     client.files_list, unpack='files', mode='page', show_files_hidden_by_limit=True, limit=200
-            ), desc='Downloading files'):
+            ), desc='Gathering files'):
                 file_id = file['id']
                 if file_id in visited:
                     continue
@@ -135,10 +181,17 @@ def update(client: WebClient, storage: Path, conv_types, content_types):
                         no_url.append(file)
 
                     else:
-                        try:
-                            download(client, url, content)
-                        except (ConnectionError, requests.ConnectionError):
-                            errors.append(file)
+                        downloads[pool.submit(download, session, url, content, file.get('size'))] = file
+
+            try:
+                for future in progress(as_completed(downloads), desc='Downloading files', total=len(downloads)):
+                    try:
+                        future.result()
+                    except (ConnectionError, requests.ConnectionError, requests.Timeout):
+                        errors.append(downloads[future])
+            except BaseException:
+                pool.shutdown(cancel_futures=True)
+                raise
 
         if errors or no_url:
             rich.print(f"[red]Couldn't download {len(errors) + len(no_url)} files[/red]")
@@ -177,6 +230,30 @@ def gather_profiles_(messages, profiles):
                     profile.setdefault('profile', {}).setdefault('real_name', att['author_subname'])
 
 
+def message_key(message):
+    return float(message['ts'])
+
+
+def load_tail(path: Path, oldest: float) -> list:
+    """ The stored messages starting from `oldest`. Only the tail is read if the history is indexed """
+    with open_index(path) as index:
+        if index is not None and index.ordered:
+            return index.read(bisect_left(index, oldest), len(index))
+
+    return [x for x in load_messages(path) if message_key(x) >= oldest]
+
+
+def is_thread_current(stored, fresh):
+    """ Whether the `stored` message has all the replies of its `fresh` copy """
+    replies = stored.get('replies')
+    return bool(replies) and replies[-1]['ts'] == fresh.get('latest_reply', replies[-1]['ts'])
+
+
+def format_ts(ts: float):
+    # timestamps have microsecond precision
+    return f'{ts:.6f}'
+
+
 def _update(new, old):
     updated = {x['id'] for x in old}
     return new + [x for x in old if x['id'] not in updated]
@@ -185,13 +262,14 @@ def _update(new, old):
 def paginated(method, /, unpack=None, mode='cursor', limit: int = None, **kwargs):
     assert mode in ('cursor', 'page')
     pagination = dict(cursor=None, limit=limit) if mode == 'cursor' else dict(page=1, count=limit)
+    limiter = get_limiter(method)
     while True:
+        limiter.acquire()
         try:
             response = method(**pagination, **kwargs)
         except SlackApiError as error:
             if error.response['error'] == 'ratelimited':
-                delay = int(error.response.headers['Retry-After'])
-                time.sleep(delay)
+                limiter.pause(int(error.response.headers.get('Retry-After', 1)))
                 continue
 
             else:
@@ -220,9 +298,58 @@ def paginated(method, /, unpack=None, mode='cursor', limit: int = None, **kwargs
                 break
 
 
-def download(client: WebClient, url, to):
-    with open(to, 'wb') as out:
-        response = requests.get(url, headers={'Authorization': f'Bearer {client.token}'}, timeout=10, stream=True)
-        response.raise_for_status()
-        for chunk in response.iter_content(chunk_size=8192):
-            out.write(chunk)
+def get_limiter(method) -> TokenBucket:
+    """ The limits are shared by all the calls to the same method, regardless of the thread """
+    name = method.__name__
+    if name not in _limiters:
+        rate = REQUESTS_PER_MINUTE[TIERS.get(name, 3)] / 60
+        _limiters.setdefault(name, TokenBucket(rate, capacity=5))
+    return _limiters[name]
+
+
+def make_session(client: WebClient, workers: int):
+    session = requests.Session()
+    session.headers['Authorization'] = f'Bearer {client.token}'
+    # keep a connection alive for each worker
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class IncompleteDownload(ConnectionError):
+    pass
+
+
+def download(session: requests.Session, url, to: Path, size: int | None = None):
+    """ Downloads into a temporary file first, and resumes the previous attempts, if any """
+    part = to.with_name(to.name + '.part')
+    offset = part.stat().st_size if part.exists() else 0
+    if size is not None and offset > size:
+        offset = 0
+    if size is not None and offset == size:
+        part.rename(to)
+        return
+
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+    with session.get(url, headers=headers, timeout=10, stream=True) as response:
+        # the previous attempt already got everything
+        if offset and response.status_code == 416:
+            pass
+
+        else:
+            response.raise_for_status()
+            # the server might ignore the range
+            if response.status_code != 206 or not response.headers.get('Content-Range', '').startswith(
+                    f'bytes {offset}-'):
+                offset = 0
+
+            with open(part, 'ab' if offset else 'wb') as out:
+                for chunk in response.iter_content(chunk_size=1024 ** 2):
+                    out.write(chunk)
+
+    actual = part.stat().st_size
+    if size is not None and actual != size:
+        raise IncompleteDownload(f'Expected {size} bytes, got {actual}: {url}')
+
+    part.rename(to)
@@ -1,3 +1,4 @@
+import datetime
 from functools import cached_property
 
 import deli
@@ -5,6 +6,7 @@ from jboc import collect
 
 from ..interface import ChatDescription, ChatInterface
 from ..schema import Agent
+from ..storage import count_messages, get_last_key, has_messages, iterate_messages, load_messages
 from .convert import convert
 from .schema import AnyMessage
 
@@ -17,7 +19,34 @@ class Slack(ChatInterface):
         return deli.load(self.root / 'emojis.json')
 
     def load(self, x):
-        return deli.load(self.root / f'messages/{x}.json')
+        return load_messages(self.get_path(x))
+
+    def iterate(self, x):
+        return iterate_messages(self.get_path(x))
+
+    def get_path(self, x):
+        return self.root / f'messages/{x}.json'
+
+    @property
+    def dependencies(self):
+        # the files' folder changes when new files are downloaded
+        return [self.root / 'files', self.root / 'emojis.json']
+
+    @property
+    def agents_dependencies(self):
+        return [self.root / 'users.json']
+
+    def load_window(self, x, before=None, after=None, limit=None):
+        window = self._load_indexed_window(x, before, after, limit)
+        if window is None:
+            window = super().load_window(x, before, after, limit)
+        return window
+
+    def get_message_id(self, msg):
+        return msg['ts']
+
+    def get_message_key(self, message_id):
+        return float(message_id)
 
     def validate(self, msg):
         return AnyMessage.validate_python(msg)
@@ -25,17 +54,27 @@ class Slack(ChatInterface):
     def convert(self, msg):
         return convert(msg, self)
 
-    def gather_chats(self):
+    @property
+    def chats_dependencies(self):
+        # the folder changes when histories are added or rewritten
+        return [self.root / 'conversations.json', self.root / 'messages']
+
+    def build_chats_index(self):
         result = []
         for x in sorted(deli.load(self.root / 'conversations.json'), key=lambda x: -x['updated']):
-            if not (self.root / 'messages' / f"{x['id']}.json").exists():
+            if not has_messages(self.get_path(x['id'])):
                 continue
 
             if x.get('is_mpim'):
                 name = x['purpose']['value']
             else:
                 name = x.get('name') or x.get('user')
-            result.append(ChatDescription(id=x['id'], name=name))
+            path = self.get_path(x['id'])
+            last = get_last_key(path, lambda m: float(m['ts']))
+            result.append(ChatDescription(
+                id=x['id'], name=name, count=count_messages(path),
+                last_activity=None if last is None else datetime.datetime.fromtimestamp(last, datetime.timezone.utc),
+            ))
 
         return result
 
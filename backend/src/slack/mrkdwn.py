@@ -1,5 +1,7 @@
 import datetime
 import re
+import threading
+from functools import lru_cache
 
 import marko
 import multimethod
@@ -14,14 +16,39 @@ from .. import elements
 
 # rules: https://api.slack.com/reference/surfaces/formatting#retrieving-messages
 pattern = re.compile(r'<([^>]*)>')
+# bot messages repeat the same texts over and over
+CACHE_SIZE = 4096
+# the parser is reused, but not shared between threads
+_local = threading.local()
 
 
 def convert_mrkdwn(text: str):
-    # TODO: convert stuff like `&amp;` to `&`
-    return list(_unpack(marko.Markdown().parse(text)))
+    # the elements are shared between calls, but the list isn't
+    return list(_convert_mrkdwn(text))
 
 
 def unpack_mrkdwn(text: str):
+    return iter(_unpack_mrkdwn(text))
+
+
+@lru_cache(CACHE_SIZE)
+def _convert_mrkdwn(text: str):
+    # TODO: convert stuff like `&amp;` to `&`
+    return tuple(_unpack(_get_parser().parse(text)))
+
+
+@lru_cache(CACHE_SIZE)
+def _unpack_mrkdwn(text: str):
+    return tuple(_iterate_mrkdwn(text))
+
+
+def _get_parser():
+    if not hasattr(_local, 'parser'):
+        _local.parser = marko.Markdown()
+    return _local.parser
+
+
+def _iterate_mrkdwn(text: str):
     start = 0
     for match in pattern.finditer(text):
         prefix = text[start:match.start()]
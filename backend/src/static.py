@@ -7,24 +7,129 @@ from pathlib import Path
 
 from starlette import status
 from starlette.requests import Request
-from starlette.responses import FileResponse, Response
+from starlette.responses import FileResponse, Response, StreamingResponse
+
+
+CHUNK_SIZE = 1024 ** 2
 
 
 def serve(request: Request, absolute: Path | str, kind: str) -> Response:
     absolute = Path(absolute)
     stat = absolute.stat()
-    if not was_modified_since(request.headers.get('HTTP_IF_MODIFIED_SINCE'), stat.st_mtime, stat.st_size):
-        return Response(status_code=status.HTTP_304_NOT_MODIFIED)
-
-    content_type, encoding = mimetypes.guess_type(kind)
-    content_type = content_type or 'application/octet-stream'
-
+    etag = get_etag(stat)
     headers = {
         'Last-Modified': http_date(stat.st_mtime),
+        'ETag': etag,
+        'Accept-Ranges': 'bytes',
     }
+
+    # If-None-Match takes precedence over If-Modified-Since: https://www.rfc-editor.org/rfc/rfc9110#section-13.1.3
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    elif not was_modified_since(request.headers.get('if-modified-since'), stat.st_mtime, stat.st_size):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    content_type, encoding = mimetypes.guess_type(kind)
+    content_type = content_type or 'application/octet-stream'
     if encoding:
         headers['Content-Encoding'] = encoding
-    return FileResponse(absolute, media_type=content_type, headers=headers)
+
+    header = request.headers.get('range')
+    if header is None:
+        return FileResponse(absolute, media_type=content_type, headers=headers)
+
+    start, stop = 0, stat.st_size
+    status_code = status.HTTP_200_OK
+    if range_applies(request.headers.get('if-range'), etag, stat.st_mtime):
+        try:
+            byte_range = parse_range(header, stat.st_size)
+        except ValueError:
+            return Response(
+                status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                headers={**headers, 'Content-Range': f'bytes */{stat.st_size}'},
+            )
+
+        if byte_range is not None:
+            start, stop = byte_range
+            status_code = status.HTTP_206_PARTIAL_CONTENT
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{stat.st_size}'
+
+    # the range is served manually, because some versions of `FileResponse` have their own opinion on it
+    headers['Content-Length'] = str(stop - start)
+    return StreamingResponse(
+        read_range(absolute, start, stop), status_code=status_code, media_type=content_type, headers=headers,
+    )
+
+
+def get_etag(stat):
+    # a strong validator: any change to the file's content changes at least one of these
+    return f'"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def etag_matches(header, etag):
+    # If-None-Match uses the weak comparison
+    if header.strip() == '*':
+        return True
+    return etag.removeprefix('W/') in {x.strip().removeprefix('W/') for x in header.split(',')}
+
+
+def range_applies(header, etag, mtime):
+    if header is None:
+        return True
+    header = header.strip()
+    # If-Range uses the strong comparison
+    if header.startswith(('"', 'W/')):
+        return header == etag
+    try:
+        return parse_http_date(header) == int(mtime)
+    except ValueError:
+        return False
+
+
+def parse_range(header, size):
+    """
+    Returns the [start, stop) bounds of a single byte range, or None if the header must be ignored.
+    Raises ValueError if the range is not satisfiable.
+    """
+    unit, _, spec = header.partition('=')
+    # multiple ranges are legal to ignore
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+
+    first, sep, last = spec.strip().partition('-')
+    if not sep or not (first or last):
+        return None
+    try:
+        first = int(first) if first else None
+        last = int(last) if last else None
+    except ValueError:
+        # syntactically invalid
+        return None
+
+    if first is None:
+        # the suffix
+        if last == 0 or size == 0:
+            raise ValueError(header)
+        return max(size - last, 0), size
+
+    if last is not None and last < first:
+        return None
+    if first >= size:
+        raise ValueError(header)
+    return first, size if last is None else min(last + 1, size)
+
+
+def read_range(path, start, stop):
+    with open(path, 'rb') as file:
+        file.seek(start)
+        while start < stop:
+            chunk = file.read(min(CHUNK_SIZE, stop - start))
+            if not chunk:
+                break
+            start += len(chunk)
+            yield chunk
 
 
 # these 3 functions were copied from Django
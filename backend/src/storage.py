@@ -0,0 +1,475 @@
+"""
+Append-friendly storage for message histories.
+
+A history which lives at `messages/{id}.json` is stored as json lines in `messages/{id}.jsonl`, along with a small
+manifest in `messages/{id}.manifest.json`. New messages are appended to the end of the file, so a sync only writes
+what's new. The manifest is replaced atomically after each write, and only the bytes it accounts for are ever read,
+so an interrupted write never corrupts the history.
+
+The messages are kept sorted by their key and deduplicated, which is recorded in the manifest as `sorted`, so readers
+don't have to sort them again. Histories written before that are sorted on their next write.
+
+Alternatively, a history can be stored compactly in `messages/{id}.blocks`: each write adds compressed blocks of json
+lines, and the manifest keeps the position of each block. The blocks are compressed with zstd if `zstandard` is
+installed, and with zlib otherwise. Both formats hold exactly the same json, so the conversion is lossless.
+
+Each history also has an offset index in `messages/{id}.idx`: the generation of the history, followed by a
+(key, offset, length) record per message, so that any window of messages can be read from a memory-mapped file without
+parsing the rest. The records can be read by numpy as well:
+`np.memmap(path, dtype=[('key', '<f8'), ('offset', '<i8'), ('length', '<i8')], offset=8)`.
+In the block format, the offset and length are the ones of the message's block.
+
+Histories in the old format (a single json array) are still readable, and are converted on the first write.
+"""
+import importlib.util
+import json
+import os
+import struct
+import zlib
+from bisect import bisect_left
+from collections.abc import Sequence
+from contextlib import contextmanager
+from enum import StrEnum
+from pathlib import Path
+from typing import Callable, Iterable
+
+import deli
+from more_itertools import chunked
+
+from .utils import file_signature, map_file
+
+
+VERSION = 1
+# messages per compressed block
+BLOCK_SIZE = 1000
+INDEX_HEADER = struct.Struct('<q')
+INDEX_RECORD = struct.Struct('<dqq')
+
+
+class StorageFormat(StrEnum):
+    lines = 'lines'
+    blocks = 'blocks'
+
+
+def has_messages(path: Path) -> bool:
+    return _manifest_path(path).exists() or path.exists()
+
+
+def load_messages(path: Path) -> list:
+    return list(iterate_messages(path))
+
+
+def iterate_messages(path: Path, offset: int = 0):
+    """ `offset` is the position in bytes to start from, e.g. the size of the history at some earlier moment """
+    manifest = get_manifest(path)
+    if manifest is None:
+        assert not offset, offset
+        if path.exists():
+            yield from deli.load(path)
+        return
+
+    if _format(manifest) == StorageFormat.blocks:
+        with open(_blocks_path(path), 'rb') as file:
+            for start, length in manifest['blocks']:
+                if start < offset:
+                    continue
+
+                file.seek(start)
+                for line in _decompress(file.read(length), manifest['codec']).splitlines():
+                    yield json.loads(line)
+        return
+
+    left = manifest['size'] - offset
+    with open(_lines_path(path), 'rb') as file:
+        file.seek(offset)
+        for line in file:
+            left -= len(line)
+            if left < 0:
+                break
+            yield json.loads(line)
+
+
+def append_messages(messages: Iterable, path: Path, key: Callable):
+    """ Adds `messages` to the end of the history. `key` is used to keep the messages sorted """
+    messages = list(messages)
+    manifest = get_manifest(path)
+    if manifest is not None and not messages:
+        return
+    # the order is restored by rewriting the whole history
+    if manifest is None or not manifest.get('sorted') or not _follows(messages, key, manifest['last']):
+        save_messages(load_messages(path) + messages, path, key)
+        return
+
+    layout = _layout(manifest)
+    with open(_data_path(path, manifest), 'r+b') as file:
+        # drop the leftovers of an interrupted write
+        file.truncate(manifest['size'])
+        file.seek(manifest['size'])
+        positions = _write(file, messages, layout)
+        file.flush()
+        os.fsync(file.fileno())
+        size = file.tell()
+
+    indexed = _is_indexed(path, manifest)
+    if indexed:
+        _append_index(path, manifest['count'], _get_records(messages, positions, key))
+
+    _save_manifest(
+        path, size, manifest['count'] + len(messages), key(messages[-1]), _generation(manifest), layout, True,
+    )
+    if not indexed:
+        index_messages(path, key)
+
+
+def save_messages(messages: Iterable, path: Path, key: Callable, format: StorageFormat | None = None):
+    """
+    Rewrites the whole history, sorted by `key`. If several messages have the same key, the last one is kept.
+    By default, the current format is kept.
+    """
+    messages = sorted({key(x): x for x in messages}.values(), key=key)
+    keys = list(map(key, messages))
+    _rewrite(messages, path, keys[-1] if keys else None, format, keys, True)
+
+
+def is_sorted(path: Path) -> bool:
+    """ Whether the history is sorted by its key, without duplicates """
+    manifest = get_manifest(path)
+    return manifest is not None and manifest.get('sorted', False)
+
+
+def convert_messages(path: Path, format: StorageFormat) -> bool:
+    """ Rewrites the history in the given format. Returns whether anything changed """
+    manifest = get_manifest(path)
+    # old histories get a manifest on their first sync
+    if manifest is None or _format(manifest) == format:
+        return False
+
+    # the order doesn't change, so the keys can be taken from the old index
+    keys = None
+    with open_index(path) as index:
+        if index is not None:
+            keys = list(index)
+
+    _rewrite(load_messages(path), path, manifest['last'], format, keys, manifest.get('sorted', False))
+    return True
+
+
+def index_messages(path: Path, key: Callable):
+    """ Builds the offset index of the history, if it's missing or stale """
+    manifest = get_manifest(path)
+    if manifest is None or _is_indexed(path, manifest):
+        return
+
+    records = []
+    with open(_data_path(path, manifest), 'rb') as file:
+        if _format(manifest) == StorageFormat.blocks:
+            for start, length in manifest['blocks']:
+                file.seek(start)
+                for line in _decompress(file.read(length), manifest['codec']).splitlines():
+                    records.append((key(json.loads(line)), start, length))
+
+        else:
+            offset = 0
+            for line in file:
+                if offset + len(line) > manifest['size']:
+                    break
+                records.append((key(json.loads(line)), offset, len(line) - 1))
+                offset += len(line)
+
+    _save_index(path, _generation(manifest), records)
+
+
+class MessageIndex(Sequence):
+    """ The keys of the messages in the order of the history, along with random access to the messages themselves """
+
+    def __init__(self, manifest, index, data, header_size: int = INDEX_HEADER.size):
+        self._manifest, self._index, self._data, self._header_size = manifest, index, data, header_size
+
+    def __len__(self):
+        return self._manifest['count']
+
+    @property
+    def ordered(self) -> bool:
+        """ Whether the keys are sorted and unique """
+        return self._manifest.get('sorted', False)
+
+    def find(self, key: float) -> list[int]:
+        """ The positions of the messages with the given key """
+        if self.ordered:
+            i = bisect_left(self, key)
+            return [i] if i < len(self) and self[i] == key else []
+        return [i for i, value in enumerate(self) if value == key]
+
+    def __getitem__(self, i: int) -> float:
+        return self._record(i)[0]
+
+    def read(self, start: int, stop: int) -> list:
+        """ The messages in the [start, stop) range """
+        return [json.loads(line) for line in self.read_lines(start, stop)]
+
+    def read_lines(self, start: int, stop: int) -> list[bytes]:
+        """ The serialized messages in the [start, stop) range """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        if _format(self._manifest) == StorageFormat.lines:
+            result = []
+            for i in range(start, stop):
+                _, offset, length = self._record(i)
+                result.append(self._data[offset:offset + length])
+            return result
+
+        result, block = [], None
+        for i in range(start, stop):
+            _, offset, length = self._record(i)
+            if block is None or offset != block[0]:
+                # the position inside the block is the distance to the block's first message
+                first = i
+                while first > 0 and self._record(first - 1)[1] == offset:
+                    first -= 1
+                lines = _decompress(self._data[offset:offset + length], self._manifest['codec']).splitlines()
+                block = offset, first, lines
+
+            result.append(block[2][i - block[1]])
+        return result
+
+    def _record(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return INDEX_RECORD.unpack_from(self._index, self._header_size + i * INDEX_RECORD.size)
+
+
+@contextmanager
+def open_index(path: Path):
+    """ Yields the `MessageIndex` of the history, or None if the index is missing or stale """
+    # the data goes first and the manifest goes last: this way the data can't be newer than a valid index
+    manifest = get_manifest(path)
+    if manifest is None:
+        yield None
+        return
+
+    try:
+        data = open(_data_path(path, manifest), 'rb')
+        index = open(_index_path(path), 'rb')
+    except FileNotFoundError:
+        yield None
+        return
+
+    with data, index:
+        manifest = get_manifest(path)
+        if manifest is None or not _is_indexed(path, manifest, index.fileno()):
+            yield None
+            return
+
+        with map_file(index) as index_map, map_file(data) as data_map:
+            yield MessageIndex(manifest, index_map, data_map)
+
+
+def count_messages(path: Path) -> int:
+    manifest = get_manifest(path)
+    if manifest is not None:
+        return manifest['count']
+    return len(load_messages(path))
+
+
+def get_last_key(path: Path, key: Callable):
+    """ The largest `key` among the stored messages, or None if there are none """
+    manifest = get_manifest(path)
+    if manifest is not None:
+        return manifest['last']
+    return max(map(key, iterate_messages(path)), default=None)
+
+
+def get_manifest(path: Path) -> dict | None:
+    manifest = _manifest_path(path)
+    if manifest.exists():
+        return deli.load(manifest)
+
+
+def get_signature(path: Path):
+    """ Changes whenever the history changes """
+    manifest = _manifest_path(path)
+    if manifest.exists():
+        return file_signature(manifest)
+    return file_signature(path)
+
+
+def migrate(path: Path, key: Callable):
+    """ Converts a history in the old format, if any """
+    if path.exists() and not _manifest_path(path).exists():
+        save_messages(load_messages(path), path, key)
+
+
+def _rewrite(messages: list, path: Path, last, format: StorageFormat | None, keys: list | None, ordered: bool):
+    # offsets from the previous generations are no longer valid
+    manifest = get_manifest(path)
+    generation = 0 if manifest is None else _generation(manifest) + 1
+    if format is None:
+        format = StorageFormat.lines if manifest is None else _format(manifest)
+
+    layout = {}
+    if format == StorageFormat.blocks:
+        layout = dict(format=format.value, codec=_default_codec(), blocks=[])
+
+    data = _blocks_path(path) if format == StorageFormat.blocks else _lines_path(path)
+    tmp = _tmp(data)
+    with open(tmp, 'wb') as file:
+        positions = _write(file, messages, layout)
+        size = file.tell()
+
+    # the index goes before the data, so that readers never see new data with an old index
+    if keys is not None:
+        _save_index(path, generation, [(k, *position) for k, position in zip(keys, positions, strict=True)])
+    else:
+        _index_path(path).unlink(missing_ok=True)
+    os.replace(tmp, data)
+    _save_manifest(path, size, len(messages), last, generation, layout, ordered)
+    # the other formats are no longer needed
+    path.unlink(missing_ok=True)
+    for other in _lines_path(path), _blocks_path(path):
+        if other != data:
+            other.unlink(missing_ok=True)
+
+
+def _save_manifest(path, size, count, last, generation, layout, ordered):
+    manifest = _manifest_path(path)
+    tmp = _tmp(manifest)
+    deli.save(dict(
+        version=VERSION, size=size, count=count, last=last, generation=generation, sorted=ordered, **layout,
+    ), tmp)
+    os.replace(tmp, manifest)
+
+
+def _write(file, messages, layout) -> list[tuple[int, int]]:
+    """
+    Writes the messages at the current position, and registers the new blocks in the `layout`.
+    Returns the offset and length of each message, for the index.
+    """
+    positions = []
+    offset = file.tell()
+    if not layout:
+        for message in messages:
+            line = _dump(message)
+            positions.append((offset, len(line) - 1))
+            file.write(line)
+            offset += len(line)
+        return positions
+
+    for chunk in chunked(messages, BLOCK_SIZE):
+        data = _compress(b''.join(map(_dump, chunk)), layout['codec'])
+        layout['blocks'].append([offset, len(data)])
+        positions.extend([(offset, len(data))] * len(chunk))
+        file.write(data)
+        offset += len(data)
+    return positions
+
+
+def _get_records(messages, positions, key):
+    return [(key(message), *position) for message, position in zip(messages, positions, strict=True)]
+
+
+def _save_index(path, generation, records):
+    index = _index_path(path)
+    tmp = _tmp(index)
+    with open(tmp, 'wb') as file:
+        file.write(INDEX_HEADER.pack(generation))
+        for record in records:
+            file.write(INDEX_RECORD.pack(*record))
+    os.replace(tmp, index)
+
+
+def _append_index(path, count, records):
+    with open(_index_path(path), 'r+b') as file:
+        file.truncate(INDEX_HEADER.size + count * INDEX_RECORD.size)
+        file.seek(0, os.SEEK_END)
+        for record in records:
+            file.write(INDEX_RECORD.pack(*record))
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def _is_indexed(path, manifest, fd=None):
+    """ Whether the index matches the manifest """
+    try:
+        if fd is None:
+            with open(_index_path(path), 'rb') as file:
+                return _is_indexed(path, manifest, file.fileno())
+
+        header = os.pread(fd, INDEX_HEADER.size, 0)
+        size = os.fstat(fd).st_size
+    except FileNotFoundError:
+        return False
+
+    if len(header) != INDEX_HEADER.size or INDEX_HEADER.unpack(header)[0] != _generation(manifest):
+        return False
+    return size >= INDEX_HEADER.size + manifest['count'] * INDEX_RECORD.size
+
+
+def _layout(manifest):
+    if _format(manifest) == StorageFormat.lines:
+        return {}
+    return dict(format=manifest['format'], codec=manifest['codec'], blocks=list(manifest['blocks']))
+
+
+def _format(manifest):
+    return StorageFormat(manifest.get('format', StorageFormat.lines))
+
+
+def _default_codec():
+    return 'zstd' if importlib.util.find_spec('zstandard') is not None else 'zlib'
+
+
+def _compress(data: bytes, codec: str):
+    if codec == 'zstd':
+        import zstandard
+
+        return zstandard.ZstdCompressor(level=9).compress(data)
+    return zlib.compress(data, 6)
+
+
+def _decompress(data: bytes, codec: str):
+    if codec == 'zstd':
+        import zstandard
+
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def _generation(manifest):
+    return manifest.get('generation', 0)
+
+
+def _follows(messages, key, last):
+    """ Whether the messages are sorted and go strictly after `last` """
+    for message in messages:
+        value = key(message)
+        if last is not None and value <= last:
+            return False
+        last = value
+    return True
+
+
+def _dump(message):
+    return json.dumps(message, ensure_ascii=False).encode() + b'\n'
+
+
+def _lines_path(path: Path):
+    return path.with_suffix('.jsonl')
+
+
+def _blocks_path(path: Path):
+    return path.with_suffix('.blocks')
+
+
+def _data_path(path: Path, manifest):
+    return _blocks_path(path) if _format(manifest) == StorageFormat.blocks else _lines_path(path)
+
+
+def _index_path(path: Path):
+    return path.with_suffix('.idx')
+
+
+def _manifest_path(path: Path):
+    return path.with_suffix('.manifest.json')
+
+
+def _tmp(path: Path):
+    return path.with_name('tmp-' + path.name)
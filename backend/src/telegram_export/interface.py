@@ -1,3 +1,5 @@
+import datetime
+
 import deli
 from jboc import collect
 
@@ -11,7 +13,18 @@ class TelegramExport(ChatInterface):
     name = 'telegram-export'
 
     def load(self, x):
-        return deli.load(self.root / f'{x}.json')['messages']
+        return deli.load(self.get_path(x))['messages']
+
+    def get_path(self, x):
+        return self.root / f'{x}.json'
+
+    @property
+    def agents_dependencies(self):
+        # `chats.json` is updated by each normalization, which matters for older backups without the index
+        return [self.root / AGENTS_INDEX, self.root / 'chats.json']
+
+    def get_message_id(self, msg):
+        return str(msg['id'])
 
     def validate(self, msg):
         return AnyMessage.validate_python(msg)
@@ -19,25 +32,42 @@ class TelegramExport(ChatInterface):
     def convert(self, msg):
         return convert(msg, self)
 
+    @property
+    def chats_dependencies(self):
+        # the folder changes when exports are added or replaced
+        return [self.root]
+
     @collect
-    def gather_chats(self):
-        for chat in self.root.glob('*.json'):
-            chat = deli.load(chat)
-            yield ChatDescription(id=str(chat['id']), name=chat['name'])
+    def build_chats_index(self):
+        for path in self.root.glob('*.json'):
+            # skip the chats lists
+            if not path.stem.lstrip('-').isdigit():
+                continue
 
-    def gather_agents(self):
-        agents = {}
-        for chat in self.root.glob('*.json'):
-            chat = deli.load(chat)
-            if chat['type'] == 'personal_chat':
-                agents[f'user{chat["id"]}'] = chat['name']
+            chat = deli.load(path)
+            dates = [int(x['date_unixtime']) for x in chat['messages'] if 'date_unixtime' in x]
+            yield ChatDescription(
+                id=str(chat['id']), name=chat['name'], count=len(chat['messages']),
+                last_activity=datetime.datetime.fromtimestamp(max(dates), datetime.timezone.utc) if dates else None,
+            )
 
-            for message in chat['messages']:
-                if message.get('from_id') and message.get('from'):
-                    agents.setdefault(message['from_id'], message['from'])
+    def gather_agents(self):
+        path = self.root / AGENTS_INDEX
+        if path.exists():
+            agents = deli.load(path)
+        else:
+            agents = self.build_agents_index()
 
         return [Agent(id=x, name=u, avatar=None, is_bot=False) for x, u in agents.items()]
 
+    def build_agents_index(self) -> dict:
+        """ Gathers the agents' names from all the chats """
+        agents = {}
+        for path in self.root.glob('*.json'):
+            if path.stem.lstrip('-').isdigit():
+                update_agents(deli.load(path), agents)
+        return agents
+
     def get_file_id(self, x):
         if x == MISSING_FILE or not (self.root / x).exists():
             return
@@ -48,4 +78,16 @@ class TelegramExport(ChatInterface):
         return absolute, absolute.suffix
 
 
+def update_agents(chat: dict, agents: dict):
+    """ Adds the agents from the `chat` to the `agents` mapping """
+    if chat['type'] == 'personal_chat':
+        agents[f'user{chat["id"]}'] = chat['name']
+
+    for message in chat['messages']:
+        if message.get('from_id') and message.get('from'):
+            agents.setdefault(message['from_id'], message['from'])
+
+
 MISSING_FILE = '(File not included. Change data exporting settings to download.)'
+# the `from_id -> name` mapping, maintained by the normalizer
+AGENTS_INDEX = 'agents.json'
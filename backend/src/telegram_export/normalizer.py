@@ -6,7 +6,9 @@ from pathlib import Path
 import deli
 from tqdm.auto import tqdm
 
-from .interface import MISSING_FILE
+from ..backup import app
+from ..utils import save_backup
+from .interface import AGENTS_INDEX, MISSING_FILE, TelegramExport, update_agents
 from .schema import AnyMessage
 
 
@@ -30,7 +32,9 @@ def transfer(path, storage):
     return relative
 
 
-def normalize(storage, root):
+@app.command()
+def normalize(storage: Path, root: Path):
+    """ Adds the telegram export from `root` to the `storage` """
     def replace(d, k):
         if k not in d:
             return
@@ -89,6 +93,15 @@ def normalize(storage, root):
 
     deli.save(current, current_path)
 
+    # update the agents
+    agents_path = storage / AGENTS_INDEX
+    if not agents_path.exists():
+        agents = TelegramExport(storage).build_agents_index()
+    else:
+        agents = deli.load(agents_path)
+        update_agents(current, agents)
+    save_backup(agents, agents_path)
+
     # update the chats list
     chats_path = storage / 'chats.json'
     if not chats_path.exists():
@@ -97,3 +110,4 @@ def normalize(storage, root):
         chats = deli.load(chats_path)
     chats[chat_id] = current['name']
     deli.save(chats, chats_path)
+    TelegramExport(storage).save_chats_index()
@@ -1,9 +1,10 @@
 import hashlib
+import re
 import secrets
 import shutil
 import string
-import time
-from collections import defaultdict
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from enum import StrEnum
 from pathlib import Path
 
@@ -13,7 +14,9 @@ from pydantic_settings import BaseSettings
 from tqdm.rich import tqdm
 
 from ..backup import app
-from ..utils import load_backup, nested_rich, save_backup
+from ..storage import append_messages, get_last_key, get_manifest, iterate_messages, migrate
+from ..utils import TokenBucket, load_backup, nested_rich, save_backup
+from .interface import TelegramSDK
 from .models.chat import Chat
 from .models.media import File
 from .models.message import CustomEmojiReaction, Message
@@ -64,7 +67,7 @@ class ChatContent(StrEnum):
 
 @app.command()
 def telegram_sdk(storage: Path, types: list[ChatType] = tuple(ChatType),
-                 content: list[ChatContent] = tuple(ChatContent)):
+                 content: list[ChatContent] = tuple(ChatContent), workers: int = 8):
     from telegram.client import Telegram  # noqa
 
     settings = TgSettings(_env_file=storage / '.env')
@@ -90,43 +93,45 @@ def telegram_sdk(storage: Path, types: list[ChatType] = tuple(ChatType),
         # system_version: str = 'unknown',
     )
     client.login()
-    download(client, storage, types, content)
+    download(client, storage, types, content, workers)
 
 
-def download(client, storage, chat_types, content_types):
+def download(client, storage, chat_types, content_types, workers: int = 8):
     storage = Path(storage)
-    # fixme
-    #  TODO: also update all chat lists
-    chats_ids = wait(client.get_chats(limit=1000))['chat_ids']
-    assert len(chats_ids) < 1000
-
     update_chats, update_messages, update_users, update_files = (x in content_types for x in ChatContent)
 
     # update the chats list
     chats_path = storage / 'chats.json'
     chats = load_backup(chats_path)
+    # the chats whose last message is known to be up to date
+    current = set()
     if update_chats:
-        for chat in set(chats_ids) - {x['id'] for x in chats}:
-            chat = wait(client.get_chat(chat))
-            chats.append(chat)
-
+        chats, current = update_chat_list(client, chats, workers)
         save_backup(chats, chats_path)
 
     # we need users beforehand to know the right chat types
     users_path = storage / 'users.json'
     users = load_backup(users_path)
     users_dict = {x['id']: User.model_validate(x) for x in users}
+    # users that Telegram doesn't know about
+    missing_users_path = storage / 'missing-users.json'
+    missing_users = set(load_backup(missing_users_path))
+    private = set()
     for chat in chats:
         chat = Chat.model_validate(chat)
         if isinstance(chat.type, Chat.ChatTypePrivate):
-            if isinstance(chat.type, Chat.ChatTypePrivate) and chat.type.user_id not in users_dict:
-                user = get_user(client, chat.type.user_id)
-                if user is not None:
-                    users.append(user)
-                    users_dict[user['id']] = User.model_validate(user)
+            private.add(chat.type.user_id)
+
+    not_found = set()
+    for user_id, user in get_users(client, private - set(users_dict) - missing_users):
+        if user is not None:
+            users.append(user)
+            users_dict[user['id']] = User.model_validate(user)
+        else:
+            not_found.add(user_id)
 
     # update the messages and gather files and users
-    chat_files, user_ids, emoji_ids = defaultdict(list), set(), set()
+    files, user_ids, emoji_ids = {}, set(), set()
     if update_messages or update_files or update_users:
         with nested_rich() as progress:
             for chat in progress(chats, desc='Processing messages'):
@@ -140,63 +145,50 @@ def download(client, storage, chat_types, content_types):
                     continue
 
                 messages_path = storage / f'messages/{chat.id}.json'
-                messages = load_backup(messages_path)
-
-                if update_messages:
-                    for message in progress(
-                            get_all_messages(
-                                client, chat.id, to_message_id=max((x['id'] for x in messages), default=None)
-                            ),
-                            desc=f'{chat.title} (id: {chat.id})', leave=False
-                    ):
-                        messages.append(message)
 
+                # the stored last message is only trusted if the chat list was synced just now
+                if update_messages and (chat.id not in current or has_new_messages(chat, messages_path)):
+                    added = list(progress(
+                        get_all_messages(client, chat.id, to_message_id=get_last_key(messages_path, message_key)),
+                        desc=f'{chat.title} (id: {chat.id})', leave=False
+                    ))
                     # drop duplicates
-                    messages = list({x['id']: x for x in messages}.values())
-                    save_backup(messages, messages_path)
-                    time.sleep(1)
+                    added = {x['id']: x for x in added}.values()
+                    append_messages(sorted(added, key=message_key), messages_path, message_key)
 
                 if update_files or update_users:
-                    for message in progress(messages, desc=f'Processing messages for {chat.title}', leave=False):
-                        message = Message.model_validate(message)
+                    refs = update_refs(messages_path, progress, desc=f'Processing messages for {chat.title}')
+                    user_ids.update(refs['users'])
+                    files.update(refs['files'])
+                    emoji_ids.update(refs['emojis'])
 
-                        user_ids.update(message.get_user_ids())
-                        chat_files[chat.id].extend(message.content.get_files())
-
-                        if message.interaction_info and message.interaction_info.reactions:
-                            for r in message.interaction_info.reactions.reactions:
-                                if isinstance(r.type, CustomEmojiReaction):
-                                    emoji_ids.add(r.type.custom_emoji_id)
-
-                        if isinstance(message.content, TextEntityCustomEmoji):
-                            emoji_ids.add(message.content.custom_emoji_id)
+    if update_chats or update_messages:
+        TelegramSDK(storage).save_chats_index()
 
     # TODO: custom emojis
 
     # update the users
     if update_users:
-        missing = 0
-        for user in user_ids - {x['id'] for x in users}:
-            user = get_user(client, user)
+        for user_id, user in get_users(client, user_ids - {x['id'] for x in users} - missing_users - not_found):
             if user is not None:
                 users.append(user)
             else:
-                missing += 1
+                not_found.add(user_id)
 
-        if missing:
-            rich.print(f'[yellow]{missing} user(s) not found[/yellow]')
+        if not_found:
+            rich.print(f'[yellow]{len(not_found)} user(s) not found[/yellow]')
         save_backup(users, users_path)
 
+    # so that they won't be requested again
+    if not_found:
+        save_backup(sorted(missing_users | not_found), missing_users_path)
+
     # gather more files
-    files = []
     for user in users:
         user = User.model_validate(user)
         if user.profile_photo:
-            files.append(user.profile_photo.big)
-            files.append(user.profile_photo.small)
-
-    for file_ids in chat_files.values():
-        files.extend(file_ids)
+            for photo in user.profile_photo.big, user.profile_photo.small:
+                files[get_file_uid(photo)] = photo.remote.id
 
     # download the files
     if update_files:
@@ -205,26 +197,28 @@ def download(client, storage, chat_types, content_types):
         skipped_db_path = files_root / 'skipped.json'
         db = load_backup(files_db_path)
         skipped = set(load_backup(skipped_db_path))
-        n_skipped = 0
         present = {x[FILE_UID_KEY] for x in db} | skipped
-        with tqdm([file for file in files if get_file_uid(file) not in present], desc='Downloading files') as bar:
+        missing = {file_id: remote_id for file_id, remote_id in files.items() if file_id not in present}
+        with (
+            tqdm(total=len(missing), desc='Downloading files') as bar,
+            FileDownloader(client) as downloader,
+            ThreadPoolExecutor(workers) as pool,
+        ):
+            futures = {
+                pool.submit(fetch_file, client, downloader, remote_id, file_id, files_root): file_id
+                for file_id, remote_id in missing.items()
+            }
             try:
-                for file in bar:
-                    file_id = get_file_uid(file)
-                    # file ids are generated each time the client is created
-                    file = File.model_validate(wait(client.call_method(
-                        'getRemoteFile', params=dict(remote_file_id=file.remote.id)
-                    )))
-                    assert file.remote.unique_id == file_id
-                    success = _update_files_db(client, file.id, files_root, db)
-                    n_skipped += not success
-                    if not success:
-                        # bar.set_postfix_str(f'Skipped: {n_skipped}')
-                        skipped.add(file_id)
-
-                    time.sleep(0.1)
+                for future in as_completed(futures):
+                    record = future.result()
+                    if record is None:
+                        skipped.add(futures[future])
+                    else:
+                        db.append(record)
+                    bar.update()
 
             except KeyboardInterrupt as e:
+                pool.shutdown(wait=False, cancel_futures=True)
                 save_backup(db, files_db_path)
                 save_backup(list(skipped), skipped_db_path)
                 raise typer.Exit(1) from e
@@ -233,22 +227,120 @@ def download(client, storage, chat_types, content_types):
             save_backup(list(skipped), skipped_db_path)
 
 
+# no limits until the server asks for them
+_limiter = TokenBucket()
+
+
+class FloodWait(RuntimeError):
+    def __init__(self, info, delay: int):
+        super().__init__(info)
+        self.delay = delay
+
+
+def call(client, method: str, **params):
+    """ Calls a tdlib method, waiting out the flood limits """
+    while True:
+        _limiter.acquire()
+        try:
+            return wait(client.call_method(method, params=params))
+        except FloodWait as e:
+            _limiter.pause(e.delay)
+
+
 def wait(response):
     response.wait()
     if response.error:
-        raise RuntimeError(response.error_info)
+        info = response.error_info
+        if info.get('code') == 429 or 'FLOOD_WAIT' in info.get('message', ''):
+            match = re.search(r'(?:retry after |FLOOD_WAIT_)(\d+)', info.get('message', ''))
+            raise FloodWait(info, int(match.group(1)) if match else 1)
+
+        raise RuntimeError(info)
+
     update = response.update
     update.pop('@extra', None)
-    time.sleep(0.1)
     return update
 
 
+CHAT_LISTS = {'@type': 'chatListMain'}, {'@type': 'chatListArchive'}
+
+
+def get_chat_list(client, batch: int = 100) -> dict:
+    """ Loads all the chat lists. Returns the last message id for each chat, as far as tdlib knows """
+    last = {}
+
+    def on_new_chat(update):
+        last[update['chat']['id']] = get_last_message_id(update['chat'])
+
+    def on_last_message(update):
+        last[update['chat_id']] = get_last_message_id(update)
+
+    client.add_update_handler('updateNewChat', on_new_chat)
+    client.add_update_handler('updateChatLastMessage', on_last_message)
+    try:
+        chat_ids = []
+        for chat_list in CHAT_LISTS:
+            # tdlib reports 404 when the whole list is loaded
+            while True:
+                try:
+                    call(client, 'loadChats', chat_list=chat_list, limit=batch)
+                except RuntimeError as e:
+                    if e.args[0].get('code') != 404:
+                        raise
+                    break
+
+            limit = 1000
+            while len(ids := call(client, 'getChats', chat_list=chat_list, limit=limit)['chat_ids']) >= limit:
+                limit *= 2
+            chat_ids.extend(ids)
+
+    finally:
+        client.remove_update_handler('updateNewChat', on_new_chat)
+        client.remove_update_handler('updateChatLastMessage', on_last_message)
+
+    # chats we got no updates for are refreshed anyway
+    return {chat_id: last.get(chat_id, ...) for chat_id in chat_ids}
+
+
+def update_chat_list(client, chats: list, workers: int) -> tuple[list, set]:
+    """
+    Adds the new chats and refreshes the ones with new messages.
+    Also returns the ids of the chats whose last message is now up to date.
+    """
+    current = get_chat_list(client)
+    known = {chat['id']: get_last_message_id(chat) for chat in chats}
+    changed = [chat_id for chat_id, last in current.items() if chat_id not in known or known[chat_id] != last]
+    if not changed:
+        return chats, set(current)
+
+    with ThreadPoolExecutor(workers) as pool:
+        fetched = pool.map(lambda chat_id: call(client, 'getChat', chat_id=chat_id), changed)
+        fetched = {chat['id']: chat for chat in fetched}
+
+    rich.print(f'Refreshed {len(fetched)} chat(s)')
+    # chats that left all the lists are kept as is
+    chats = [fetched.pop(chat['id'], chat) for chat in chats]
+    chats.extend(fetched.values())
+    return chats, set(current)
+
+
+def has_new_messages(chat: Chat, path: Path):
+    last = get_last_key(path, message_key)
+    return last is None or not chat.last_message or chat.last_message['id'] > last
+
+
+def get_last_message_id(chat: dict):
+    message = chat.get('last_message')
+    return message and message['id']
+
+
 def get_all_messages(client, chat_id, to_message_id: int | None = None):
     from_message_id = 0
     while True:
-        response = wait(client.get_chat_history(chat_id=chat_id, limit=1000, from_message_id=from_message_id))
+        response = call(client, 'getChatHistory', chat_id=chat_id, limit=1000, from_message_id=from_message_id)
         for message in response['messages']:
-            if to_message_id is not None and message['id'] == to_message_id:
+            # the message might have been deleted, so we can't just wait for the exact id
+            if to_message_id is not None and message['id'] <= to_message_id:
                 return
 
             yield message
@@ -257,82 +349,177 @@ def get_all_messages(client, chat_id, to_message_id: int | None = None):
         if not response['total_count']:
             return
 
-        time.sleep(1)
 
+def message_key(message):
+    return message['id']
 
-def get_user(client, user):
-    try:
-        return wait(client.get_user(user))
-    except RuntimeError as e:
-        if e.args[0]['message'] != 'User not found':
-            raise
 
+REFS_VERSION = 1
 
-def download_file(client, file_id, storage):
-    db_path = storage / 'files.json'
-    db = load_backup(db_path)
-    _update_files_db(client, file_id, storage, db)
-    save_backup(db, db_path)
 
+def update_refs(path: Path, progress, desc: str):
+    """
+    Gathers the users, files and emojis referenced in the history.
+    They are stored next to the history, so that only the messages added since the last time need to be parsed.
+    """
+    migrate(path, message_key)
+    manifest = get_manifest(path)
+    if manifest is None:
+        return dict(users=[], files={}, emojis=[])
 
-def _update_files_db(client, file_id, storage, db) -> bool:
-    def done(file):
-        return file.local.is_downloading_completed and file.local.path
+    refs_path = path.with_suffix('.refs.json')
+    refs = load_backup(refs_path)
+    if (
+            not refs or refs['version'] != REFS_VERSION or refs['generation'] != manifest.get('generation', 0)
+            or refs['size'] > manifest['size']
+    ):
+        refs = dict(
+            version=REFS_VERSION, generation=manifest.get('generation', 0), size=0, users=[], files={}, emojis=[],
+        )
 
-    def handler(update):
-        nonlocal path
-        file = update['file']
-        file.pop('@extra', None)
-        file = File.model_validate(file)
-        if file.id == file_id:
-            if done(file):
-                path = file.local.path
-            elif not (file.local.is_downloading_active or file.local.is_downloading_completed):
-                path = False
+    if refs['size'] == manifest['size']:
+        return refs
 
-    if any(x[FILE_UID_KEY] == file_id for x in db):
-        return True
+    users, files, emojis = set(refs['users']), refs['files'], set(refs['emojis'])
+    for message in progress(iterate_messages(path, refs['size']), desc=desc, leave=False):
+        message = Message.model_validate(message)
 
-    path = None
-    storage = Path(storage)
-    client.add_update_handler('updateFile', handler)
-    try:
-        result = wait(client.call_method('downloadFile', params=dict(file_id=file_id, priority=1, synchronous=False)))
-        result = File.model_validate(result)
-        if done(result):
-            path = result.local.path
+        users.update(message.get_user_ids())
+        for file in message.content.get_files():
+            files[get_file_uid(file)] = file.remote.id
 
-        while path is None:
-            time.sleep(0.01)
+        if message.interaction_info and message.interaction_info.reactions:
+            for r in message.interaction_info.reactions.reactions:
+                if isinstance(r.type, CustomEmojiReaction):
+                    emojis.add(r.type.custom_emoji_id)
 
-        if not path:
-            return False
+        if isinstance(message.content, TextEntityCustomEmoji):
+            emojis.add(message.content.custom_emoji_id)
 
-        if not isinstance(path, str):
-            raise RuntimeError(path)
+    refs.update(size=manifest['size'], users=sorted(users), files=files, emojis=sorted(emojis))
+    save_backup(refs, refs_path)
+    return refs
 
-        path = Path(path)
-        hasher = hashlib.sha256()
-        with open(path, 'rb') as fd:
-            while content := fd.read(1024 ** 2):
-                hasher.update(content)
 
-        if '.' not in path.name:
-            ext = ''
-        else:
-            ext = '.' + path.name.split('.')[-1]
+def get_user(client, user):
+    try:
+        return call(client, 'getUser', user_id=user)
+    except RuntimeError as e:
+        if e.args[0]['message'] != 'User not found':
+            raise
 
-        filename = hasher.hexdigest()
-        if not (storage / filename).exists():
-            shutil.copyfile(path, storage / filename)
-        db.append(dict(
-            id=file_id, filename=filename, ext=ext, remote_id=result.remote.id, remote_uid=result.remote.unique_id,
-        ))
 
-    finally:
-        client.remove_update_handler('updateFile', handler)
+def get_users(client, user_ids, batch: int = 100):
+    """
+    Yields pairs (user_id, user), the user is None if it wasn't found.
+    The requests are sent in batches, without waiting for the previous responses.
+    """
+    user_ids = list(user_ids)
+    for start in range(0, len(user_ids), batch):
+        chunk = user_ids[start:start + batch]
+        responses = []
+        for user_id in chunk:
+            _limiter.acquire()
+            responses.append(client.call_method('getUser', params=dict(user_id=user_id)))
+
+        for user_id, response in zip(chunk, responses):
+            try:
+                yield user_id, wait(response)
+            except FloodWait as e:
+                _limiter.pause(e.delay)
+                yield user_id, get_user(client, user_id)
+            except RuntimeError as e:
+                if e.args[0]['message'] != 'User not found':
+                    raise
+                yield user_id, None
+
+
+class FileDownloader:
+    """ Tracks the downloads started by `downloadFile`. Their completion is signalled by the `updateFile` handler """
+
+    def __init__(self, client):
+        self.client = client
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.client.add_update_handler('updateFile', self._handle)
+        return self
+
+    def __exit__(self, *args):
+        self.client.remove_update_handler('updateFile', self._handle)
+
+    def download(self, file_id: int) -> str | None:
+        """ Blocks until the file is downloaded. Returns its local path, or None if the download was cancelled """
+        future = Future()
+        with self._lock:
+            self._pending[file_id] = future
+
+        try:
+            result = File.model_validate(call(
+                self.client, 'downloadFile', file_id=file_id, priority=1, synchronous=False
+            ))
+            # the file might be already downloaded, so there will be no updates
+            self._resolve(result, finished_only=True)
+            return future.result()
+
+        finally:
+            with self._lock:
+                self._pending.pop(file_id, None)
+
+    def _handle(self, update):
+        file = update['file']
+        file.pop('@extra', None)
+        self._resolve(File.model_validate(file))
+
+    def _resolve(self, file: File, finished_only: bool = False):
+        with self._lock:
+            future = self._pending.get(file.id)
+            if future is None or future.done():
+                return
+
+            if file.local.is_downloading_completed and file.local.path:
+                future.set_result(file.local.path)
+            elif not finished_only and not (file.local.is_downloading_active or file.local.is_downloading_completed):
+                future.set_result(None)
 
-    return True
+
+def download_file(client, file: File, storage):
+    db_path = storage / 'files.json'
+    db = load_backup(db_path)
+    if not any(x[FILE_UID_KEY] == get_file_uid(file) for x in db):
+        with FileDownloader(client) as downloader:
+            record = fetch_file(client, downloader, file.remote.id, get_file_uid(file), storage)
+        if record is not None:
+            db.append(record)
+            save_backup(db, db_path)
+
+
+def fetch_file(client, downloader: FileDownloader, remote_id: str, file_id: str, storage) -> dict | None:
+    """ Downloads the file and copies it to the storage. Returns None if the download was cancelled """
+    # file ids are generated each time the client is created
+    file = File.model_validate(call(client, 'getRemoteFile', remote_file_id=remote_id))
+    assert file.remote.unique_id == file_id
+    path = downloader.download(file.id)
+    if path is None:
+        return None
+
+    path = Path(path)
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as fd:
+        while content := fd.read(1024 ** 2):
+            hasher.update(content)
+
+    if '.' not in path.name:
+        ext = ''
+    else:
+        ext = '.' + path.name.split('.')[-1]
+
+    filename = hasher.hexdigest()
+    storage = Path(storage)
+    if not (storage / filename).exists():
+        shutil.copyfile(path, storage / filename)
+    return dict(id=file.id, filename=filename, ext=ext, remote_id=file.remote.id, remote_uid=file.remote.unique_id)
 
 
 FILE_UID_KEY = 'remote_uid'
@@ -1,3 +1,4 @@
+import datetime
 from functools import cached_property
 
 import deli
@@ -5,6 +6,7 @@ from jboc import collect
 
 from ..interface import ChatDescription, ChatInterface
 from ..schema import Agent
+from ..storage import count_messages, has_messages, is_sorted, iterate_messages, load_messages
 from .models.chat import Chat
 from .models.message import Message
 from .models.user import User
@@ -30,7 +32,44 @@ class TelegramSDK(ChatInterface):
         # return {x['id']: x['emoji'] for x in deli.load(self.root / 'custom-emojis.json')}
 
     def load(self, x):
-        return sorted(deli.load(self.root / f'messages/{x}.json'), key=lambda v: v['date'])
+        path = self.get_path(x)
+        # sorted histories are ordered by id, which follows the date
+        if is_sorted(path):
+            return load_messages(path)
+        return sorted(load_messages(path), key=lambda v: v['date'])
+
+    def iterate(self, x):
+        path = self.get_path(x)
+        if is_sorted(path):
+            return iterate_messages(path)
+        return iter(self.load(x))
+
+    def load_window(self, x, before=None, after=None, limit=None):
+        window = None
+        # otherwise the order on disk is not the order of the chat
+        if is_sorted(self.get_path(x)):
+            window = self._load_indexed_window(x, before, after, limit)
+        if window is None:
+            window = super().load_window(x, before, after, limit)
+        return window
+
+    def get_path(self, x):
+        return self.root / f'messages/{x}.json'
+
+    @property
+    def dependencies(self):
+        return [self.root / 'files/files.json']
+
+    @property
+    def agents_dependencies(self):
+        # the avatars depend on the downloaded files
+        return [self.root / 'users.json', self.root / 'files/files.json']
+
+    def get_message_id(self, msg):
+        return str(msg['id'])
+
+    def get_message_key(self, message_id):
+        return int(message_id)
 
     def validate(self, msg):
         return Message.model_validate(msg)
@@ -38,15 +77,20 @@ class TelegramSDK(ChatInterface):
     def convert(self, msg):
         return msg.convert(self)
 
+    @property
+    def chats_dependencies(self):
+        # the folder changes when histories are added or rewritten
+        return [self.root / 'chats.json', self.root / 'messages']
+
     @collect
-    def gather_chats(self):
+    def build_chats_index(self):
         for chat in sorted(
                 deli.load(self.root / 'chats.json'),
                 key=lambda x: x.get('last_message', {}).get('date', 0), reverse=True,
         ):
             chat = Chat.model_validate(chat)
             # skip missing chats
-            if not (self.root / f'messages/{chat.id}.json').exists():
+            if not has_messages(self.get_path(chat.id)):
                 continue
             # and empty ones
             if chat.last_message and chat.last_message['content']['@type'] == 'messageContactRegistered':
@@ -64,7 +108,12 @@ class TelegramSDK(ChatInterface):
             # if chat.id == 777000:
             #     continue
 
-            yield ChatDescription(id=str(chat.id), name=chat.title)
+            yield ChatDescription(
+                id=str(chat.id), name=chat.title, count=count_messages(self.get_path(chat.id)),
+                last_activity=chat.last_message and datetime.datetime.fromtimestamp(
+                    chat.last_message['date'], datetime.timezone.utc
+                ),
+            )
         # for chat in settings.telegram_api_root.glob('messages/*.json'):
         #     yield Chat(id=chat.stem, name=chat.stem, source='telegramapi')
         # chat = deli.load(chat)
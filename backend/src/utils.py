@@ -1,4 +1,8 @@
 import contextlib
+import mmap
+import os
+import threading
+import time
 from typing import Annotated, TypeVar
 
 import deli
@@ -36,6 +40,89 @@ def split_into_segments(xs, predicate):
     yield value, current
 
 
+def select_window(xs, get_id, before=None, after=None, limit: int = None):
+    """
+    Returns the messages strictly between the `after` and `before` cursors.
+    If `limit` is given, the window is anchored at `after` when only it is present, and at the end otherwise.
+    """
+    start, stop = 0, len(xs)
+    if before is not None or after is not None:
+        missing = {x for x in (before, after) if x is not None}
+        for i, x in enumerate(xs):
+            identifier = get_id(x)
+            if identifier == after:
+                start = i + 1
+                missing.discard(after)
+            if identifier == before:
+                stop = i
+                missing.discard(before)
+
+        if missing:
+            raise KeyError(*missing)
+
+    if limit is not None:
+        if after is not None and before is None:
+            stop = min(stop, start + limit)
+        else:
+            start = max(start, stop - limit)
+
+    return xs[start:stop]
+
+
+def select_indexed_window(index, locate, before=None, after=None, limit: int = None, serialized: bool = False):
+    """
+    The same as `select_window`, but only the selected messages are read from the `index`.
+    `locate` returns the position of a message by its id, or None if there is no such message.
+    If `serialized` is True, the messages are not parsed.
+    """
+    start, stop = 0, len(index)
+    missing = []
+    if after is not None:
+        position = locate(after)
+        if position is None:
+            missing.append(after)
+        else:
+            start = position + 1
+    if before is not None:
+        position = locate(before)
+        if position is None:
+            missing.append(before)
+        else:
+            stop = position
+
+    if missing:
+        raise KeyError(*missing)
+
+    if limit is not None:
+        if after is not None and before is None:
+            stop = min(stop, start + limit)
+        else:
+            start = max(start, stop - limit)
+
+    if serialized:
+        return index.read_lines(start, stop)
+    return index.read(start, stop)
+
+
+def file_signature(path):
+    if not path.exists():
+        return None
+    stat = path.stat()
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+@contextlib.contextmanager
+def map_file(file):
+    """ Maps the whole opened file to memory, for reading """
+    # empty files can't be mapped
+    if not os.fstat(file.fileno()).st_size:
+        yield b''
+        return
+
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as result:
+        yield result
+
+
 def load_backup(path):
     if path.exists():
         try:
@@ -55,6 +142,48 @@ def save_backup(data, path):
     tmp.rename(path)
 
 
+class TokenBucket:
+    """
+    A thread-safe rate limiter: allows `rate` requests per second on average, and bursts of up to `capacity` requests.
+    If `rate` is None, the only limits are the explicit pauses.
+    """
+
+    def __init__(self, rate: float | None = None, capacity: float = 1):
+        self.rate, self.capacity = rate, capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                delay = self._paused_until - now
+                if delay <= 0:
+                    if self.rate is None:
+                        return
+
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+
+                    delay = (1 - self._tokens) / self.rate
+
+            time.sleep(delay)
+
+    def pause(self, seconds: float):
+        """ Blocks all the requests for the next `seconds`, e.g. when the server asks us to slow down """
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + seconds)
+            # start from an empty bucket afterwards
+            self._tokens = 0
+            self._updated = self._paused_until
+
+
 @contextlib.contextmanager
 def nested_rich():
     def add(xs, desc=None, leave=True, total=None, **kwargs):
@@ -0,0 +1,124 @@
+import datetime
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import deli
+import rich
+import typer
+from pydantic import ValidationError
+from rich.table import Table
+from tqdm.auto import tqdm
+
+from .backup import app
+from .interface import ChatInterface
+from .storage import get_signature
+
+
+# how many failures to show for each group
+EXAMPLES = 3
+
+
+@app.command()
+def validate(workers: int = os.cpu_count(), since: datetime.datetime | None = None, report: Path | None = None):
+    """ Validates and converts all the messages, and reports all the failures """
+    chats = []
+    for interface in ChatInterface.all().values():
+        for chat in interface.gather_chats():
+            if since is None or _changed_since(interface, chat.id, since):
+                chats.append((interface.name, chat.id))
+
+    failures = []
+    with ProcessPoolExecutor(workers) as pool:
+        futures = {pool.submit(check_chat, source, chat_id): (source, chat_id) for source, chat_id in chats}
+        for future in tqdm(as_completed(futures), total=len(futures), desc='Validating chats'):
+            try:
+                failures.extend(future.result())
+            except Exception as e:
+                # the chat itself couldn't be read
+                source, chat_id = futures[future]
+                failures.append(dict(
+                    source=source, chat_id=chat_id, message_id=None, stage='load', model='', error=type(e).__name__,
+                    details=str(e),
+                ))
+
+    if report is not None:
+        deli.save(failures, report)
+    if not failures:
+        rich.print(f'[green]All {len(chats)} chat(s) are valid[/green]')
+        return
+
+    groups = defaultdict(list)
+    for failure in failures:
+        groups[failure['stage'], failure['model'], failure['error']].append(failure)
+
+    table = Table('stage', 'model', 'error', 'count', 'examples')
+    for (stage, model, error), group in sorted(groups.items(), key=lambda x: -len(x[1])):
+        examples = '\n'.join(f'{x["source"]}/{x["chat_id"]}/{x["message_id"]}' for x in group[:EXAMPLES])
+        table.add_row(stage, model, error, str(len(group)), examples)
+
+    rich.print(table)
+    failed = {(x['source'], x['chat_id']) for x in failures}
+    rich.print(f'[red]{len(failures)} message(s) failed in {len(failed)} chat(s)[/red]')
+    raise typer.Exit(1)
+
+
+def check_chat(source: str, chat_id: str) -> list[dict]:
+    """ Runs in a separate process. Returns the failures instead of stopping at the first one """
+    interface = ChatInterface.find(source)
+    failures = []
+
+    def fail(stage, model, error, message, exception):
+        try:
+            message_id = interface.get_message_id(message)
+        except Exception:
+            message_id = None
+
+        failures.append(dict(
+            source=source, chat_id=chat_id, message_id=message_id, stage=stage, model=model, error=error,
+            details=str(exception),
+        ))
+
+    for message in interface.iterate(chat_id):
+        try:
+            validated = interface.validate(message)
+        except ValidationError as e:
+            fail('validate', *_describe(e), message, e)
+            continue
+        except Exception as e:
+            fail('validate', '', type(e).__name__, message, e)
+            continue
+
+        try:
+            interface.convert(validated)
+        except Exception as e:
+            fail('convert', type(validated).__name__, type(e).__name__, message, e)
+
+    return failures
+
+
+def _describe(e: ValidationError):
+    """ The model and the error type, to group the failures by """
+    errors = e.errors()
+    model = e.title
+    if model.startswith(('union[', 'tagged-union[')):
+        # unions report the errors for each option, the closest match is the one that got the furthest
+        options = defaultdict(list)
+        for error in errors:
+            options[error['loc'][0] if error['loc'] else model].append(error)
+        model, errors = max(options.items(), key=lambda x: (max(len(e['loc']) for e in x[1]), -len(x[1])))
+        errors = [dict(x, loc=x['loc'][1:]) for x in errors]
+
+    error = max(errors, key=lambda x: len(x['loc']))
+    loc = error['loc']
+    # the list indices would split the groups
+    loc = '.'.join(x for x in loc if isinstance(x, str))
+    return model, f'{error["type"]} at {loc}' if loc else error['type']
+
+
+def _changed_since(interface, chat_id, since: datetime.datetime):
+    signature = get_signature(interface.get_path(chat_id))
+    if signature is None:
+        return True
+    return signature[0] / 1e9 >= since.timestamp()
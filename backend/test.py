@@ -1,19 +1,6 @@
-from tqdm.auto import tqdm
+import typer
 
-from src.interface import ChatInterface
+from src.validate import validate
 
 
-for interface in ChatInterface.all().values():
-    bar = tqdm(interface.gather_chats(), desc=interface.name)
-    for chat in bar:
-        bar.set_postfix(chat=chat.name)
-        for msg in interface.load(chat.id):
-            try:
-                msg = interface.validate(msg)
-            except Exception as e:
-                raise RuntimeError(msg, chat) from e
-
-            try:
-                ready = interface.convert(msg)
-            except Exception as e:
-                raise RuntimeError(msg, chat) from e
+typer.run(validate)